@@ -15,6 +15,12 @@ __copyright__ = "Copyright (c) 2014, Franz Greiling"
 __licence__ = "BSD 2-Clause License"
 __version__ = "v1.0"
 
+#: Name of the ScanIndex inside the workflow's cache directory
+INDEX = "installables.json"
+
+#: Name of the InstallLedger inside the workflow's storage directory
+LEDGER = "installed.json"
+
 
 def list_installables(query=None,
                       paths=Installable.PATHS,
@@ -31,11 +37,12 @@ def list_installables(query=None,
         Returns Alfred Feedback XML containing one Item per Installable
     """
 
-    apps = Installable.get_installables(paths, types)
+    apps = Installable.get_installables(paths, types,
+                                        index=alp.cache(INDEX), lazy=True)
 
     # Sort by Creation time; Newest come first
     apps = sorted(apps,
-                  key=lambda f: os.path.getctime(f.path),
+                  key=lambda f: f.ctime,
                   reverse=True)
 
     fb = []
@@ -75,7 +82,8 @@ def install(query, prefix='/Applications/', overrite='True', remove=False):
         ret = app.install(
             prefix=prefix,
             remove=remove,
-            overrite=overrite
+            overrite=overrite,
+            ledger=alp.storage(LEDGER),
         )
         if ret != app.path:
             print("Error installing Application")
@@ -8,7 +8,7 @@ import sys
 import plistlib
 import unicodedata
 import codecs
-from .core_dependencies import six
+import tempfile
 from .core_dependencies import biplist
 
 
@@ -55,9 +55,13 @@ def local(join=None):
     return localPath
 
 
-def cache(join=None):
+def _cachePath():
     bundleID = bundle()
-    vPath = os.path.expanduser(os.path.join("~/Library/Caches/com.runningwithcrayons.Alfred-2/Workflow Data/", bundleID))
+    return os.path.expanduser(os.path.join("~/Library/Caches/com.runningwithcrayons.Alfred-2/Workflow Data/", bundleID))
+
+
+def cache(join=None):
+    vPath = _cachePath()
 
     if not os.path.exists(vPath):
         os.makedirs(vPath)
@@ -85,24 +89,64 @@ def readPlist(path):
     # With thanks to https://github.com/congalong for solving the biplist problem
     if not os.path.isabs(path):
         path = storage(path)
-    
-    if not isinstance(path, six.binary_type):
-        with codecs.open(path, "r", "utf-8") as f:
-            s = f.read()
-        return plistlib.readPlistFromString(s)
-    else:
-        return biplist.readPlist(path)
 
+    with open(path, "rb") as f:
+        if biplist.is_stream_binary_plist(f):
+            return biplist.readPlist(f, useMmap=True)
+
+    with codecs.open(path, "r", "utf-8") as f:
+        s = f.read()
+    return plistlib.readPlistFromString(s)
 
-def writePlist(obj, path):
+
+def _isCached(path):
+    # Outside of a workflow there is no bundle, and therefore no cache
+    try:
+        cachePath = _cachePath()
+    except Exception:
+        return False
+    return os.path.abspath(path).startswith(os.path.join(cachePath, ""))
+
+
+def writePlist(obj, path, binary=None):
+    # Plists in the cache are written as binary plists by default
     if not os.path.isabs(path):
         path = storage(path)
-    
+
+    if binary is None:
+        binary = _isCached(path)
+
+    if binary:
+        biplist.writePlist(obj, path)
+        return
+
     s = plistlib.writePlistToString(obj)
     with codecs.open(path, "w", "utf-8") as f:
         f.write(s)
 
 
+def updatePlist(changes, path, remove=(), maxWaste=0.5):
+    # Binary plists are patched in place, see biplist.updatePlist
+    if not os.path.isabs(path):
+        path = storage(path)
+
+    if not os.path.exists(path):
+        biplist.writePlist(changes, path)
+        return
+
+    with open(path, "rb") as f:
+        binary = biplist.is_stream_binary_plist(f)
+
+    if binary:
+        biplist.updatePlist(path, changes, remove, maxWaste=maxWaste)
+    else:
+        obj = readPlist(path)
+        for k in remove:
+            obj.pop(k, None)
+        obj.update(changes)
+        writePlist(obj, path)
+
+
 def jsonLoad(path, default=None):
     if not os.path.isabs(path):
         path = storage(path)
@@ -112,8 +156,7 @@ def jsonLoad(path, default=None):
             read = json.load(f)
         return read
     elif default != None:
-        with codecs.open(path, "w", "utf-8") as f:
-            json.dump(default, f)
+        jsonDump(default, path)
         return default
     else:
         with codecs.open(path, "w", "utf-8") as f:
@@ -121,12 +164,43 @@ def jsonLoad(path, default=None):
         return None
 
 
-def jsonDump(obj, path):
+def jsonDump(obj, path, fsync=False):
+    # Written to a temporary file and renamed, so a crash never leaves a
+    # truncated file behind. With fsync, the data is on disk on return.
     if not os.path.isabs(path):
         path = storage(path)
 
-    with codecs.open(path, "w", "utf-8") as f:
-        json.dump(obj, f)
+    # mkstemp creates the file as 0600; keep the mode of the file it
+    # replaces, or the one a new file would get
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode & 0o7777
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    renamed = False
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(obj, f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        os.rename(tmp, path)
+        renamed = True
+    finally:
+        if not renamed:
+            os.remove(tmp)
+
+    if fsync:
+        dirfd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
 
 
 def find(query):
@@ -49,16 +49,20 @@ from collections import namedtuple
 import calendar
 import datetime
 import math
+import mmap
+import os
 import plistlib
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
 import sys
+import tempfile
 import time
 
 import alp.core_dependencies.six as six
 
 __all__ = [
     'Uid', 'Data', 'readPlist', 'writePlist', 'readPlistFromString',
-    'writePlistToString', 'InvalidPlistException', 'NotBinaryPlistException'
+    'writePlistToString', 'updatePlist', 'InvalidPlistException',
+    'NotBinaryPlistException'
 ]
 
 apple_reference_date_offset = 978307200
@@ -81,15 +85,18 @@ class NotBinaryPlistException(Exception):
     """Raised when a binary plist was expected but not encountered."""
     pass
 
-def readPlist(pathOrFile):
-    """Raises NotBinaryPlistException, InvalidPlistException"""
+def readPlist(pathOrFile, useMmap=False):
+    """Raises NotBinaryPlistException, InvalidPlistException
+    
+    If useMmap is True, files are memory-mapped instead of being read
+    into memory, see PlistReader."""
     didOpen = False
     result = None
     if isinstance(pathOrFile, (six.binary_type, six.text_type)):
         pathOrFile = open(pathOrFile, 'rb')
         didOpen = True
     try:
-        reader = PlistReader(pathOrFile)
+        reader = PlistReader(pathOrFile, useMmap=useMmap)
         result = reader.parse()
     except NotBinaryPlistException as e:
         try:
@@ -133,6 +140,110 @@ def writePlist(rootObject, pathOrFile, binary=True):
             pathOrFile.close()
         return result
 
+def updatePlist(path, changes, removals=(), maxWaste=0.5):
+    """Sets the keys in changes and removes the keys in removals in the
+    dict at the root of the binary plist at path.
+    
+    Instead of rewriting the file, the new values and a new root dict are
+    written over the old offset table, followed by a new offset table and
+    trailer. Replaced objects are left unused in the file. The number of
+    unused bytes is kept in the 5 unused bytes at the start of the
+    trailer, which readers ignore. If more than maxWaste of the file would
+    be unused, or the object refs of the file are too small for the new
+    objects, the whole file is rewritten instead.
+    
+    Raises NotBinaryPlistException, InvalidPlistException"""
+    with open(path, 'r+b') as f:
+        reader = PlistReader(f, useMmap=True)
+        mapped = reader.loadContents()
+        try:
+            trailer = reader.trailer
+            reader.setCurrentOffsetToObjectNumber(trailer.topLevelObjectNumber)
+            root = reader.readMarkedObject()
+            if not isinstance(root, ContainerFrame) or root.kind != 'dict':
+                raise InvalidPlistException("The root object is not a dictionary.")
+            count = len(root.refs)//2
+            keyRefs = root.refs[:count]
+            valueRefs = root.refs[count:]
+            keys = [reader.readObjectNumber(ref) for ref in keyRefs]
+            
+            entries = []
+            replaced = []
+            for (key, keyRef, valueRef) in zip(keys, keyRefs, valueRefs):
+                if key not in removals and key not in changes:
+                    entries.append((keyRef, valueRef))
+                else:
+                    replaced.extend((keyRef, valueRef))
+            
+            writer = PlistWriter(f)
+            changed = list(changes.items())
+            for (key, value) in changed:
+                writer.computeOffsets(key, asReference=True)
+                writer.computeOffsets(value, asReference=True)
+            objectCount = trailer.offsetCount + len(writer.computedUniques) + writer.computedContainers + 1
+            if writer.intSize(objectCount - 1) > trailer.objectRefSize:
+                compact = True
+            else:
+                compact = False
+                writer.trailer.objectRefSize = trailer.objectRefSize
+                writer.referenceFormat = SizedIntegerFormats[trailer.objectRefSize]
+                writer.numberBase = trailer.offsetCount
+                writer.positionBase = trailer.offsetTableOffset
+                (numbers, output) = writer.writeValues([item for pair in changed for item in pair], bytearray())
+                entries.extend(zip(numbers[0::2], numbers[1::2]))
+                
+                rootNumber = writer.numberBase + len(writer.writtenObjects)
+                rootPosition = writer.positionBase + len(output)
+                output += writer.binaryLength(0b1101, len(entries))
+                for entry in (0, 1):
+                    for refs in entries:
+                        output += pack(writer.referenceFormat, refs[entry])
+                
+                offsets = reader.offsets
+                offsets.extend(writer.containerPositions.get(number, None) for number in range(writer.numberBase, rootNumber))
+                offsetSize = writer.intSize(rootPosition)
+                tableOffset = writer.positionBase + len(output)
+                for (i, obj) in enumerate(writer.writtenObjects):
+                    if offsets[trailer.offsetCount + i] is None:
+                        if isinstance(obj, six.text_type) and obj == six.u(''):
+                            obj = six.b('')
+                        offsets[trailer.offsetCount + i] = writer.referencePositions[writer.referenceKey(obj)]
+                offsets.append(rootPosition)
+                output += pack('>%d%s' % (len(offsets), SizedIntegerFormats[offsetSize][1]), *offsets)
+                
+                # The old root dict and everything below the replaced
+                # values is unused now, unless it is shared
+                unused = unpack_from('>Q', reader.contents, len(reader.contents) - 32)[0] >> 24
+                unused += reader.readObjectSize(trailer.topLevelObjectNumber)[0]
+                unused += reader.readReachableSize(replaced)
+                unused = min(unused, 0xFFFFFFFFFF)
+                output += pack('>QQQQ', unused << 24 | offsetSize << 8 | trailer.objectRefSize, len(offsets), rootNumber, tableOffset)
+                
+                if maxWaste is not None:
+                    compact = unused > maxWaste*(writer.positionBase + len(output))
+        finally:
+            reader.unloadContents(mapped)
+        
+        if not compact:
+            f.seek(writer.positionBase)
+            f.write(bytes(output))
+            f.truncate()
+            return
+    
+    # Compact by writing the whole plist to a temporary file
+    result = readPlist(path)
+    for key in removals:
+        result.pop(key, None)
+    result.update(changes)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            writePlist(result, f)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
 def readPlistFromString(data):
     return readPlist(six.BytesIO(data))
 
@@ -158,19 +269,67 @@ def is_stream_binary_plist(stream):
         return False
 
 PlistTrailer = namedtuple('PlistTrailer', 'offsetSize, objectRefSize, offsetCount, topLevelObjectNumber, offsetTableOffset')
+SizedIntegerFormats = {1: '>B', 2: '>H', 4: '>L', 8: '>q'}
+# Offset tables with at least this many entries are decoded with numpy,
+# if it is available. It is only imported for the first such table, so
+# importing biplist stays cheap.
+NumpyMinimumCount = 4096
+numpy = None
+numpyImported = False
 PlistByteCounts = namedtuple('PlistByteCounts', 'nullBytes, boolBytes, intBytes, realBytes, dateBytes, dataBytes, stringBytes, uidBytes, arrayBytes, setBytes, dictBytes')
 
+# Marks objects in PlistReader.objects which have not been decoded yet
+NotDecoded = object()
+
+def importNumpy():
+    """Returns the numpy module, importing it on first use, or None if it
+       is not available."""
+    global numpy, numpyImported
+    if not numpyImported:
+        numpyImported = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+class ContainerFrame(object):
+    """An array, set or dict whose members are being decoded by
+       PlistReader.readContainers."""
+    __slots__ = ('kind', 'number', 'refs', 'values')
+    
+    def __init__(self, kind, refs, number=None):
+        self.kind = kind
+        self.number = number
+        self.refs = refs
+        self.values = []
+    
+    def build(self):
+        if self.kind == 'set':
+            return set(self.values)
+        elif self.kind == 'dict':
+            count = len(self.values)//2
+            return dict(zip(self.values[:count], self.values[count:]))
+        return self.values
+
 class PlistReader(object):
     file = None
     contents = ''
     offsets = None
+    objects = None
     trailer = None
     currentOffset = 0
+    useMmap = False
     
-    def __init__(self, fileOrStream):
-        """Raises NotBinaryPlistException."""
+    def __init__(self, fileOrStream, useMmap=False):
+        """Raises NotBinaryPlistException.
+        
+        If useMmap is True and fileOrStream is a real file, the file is
+        memory-mapped instead of being read into memory. Only the strings
+        and data objects which are actually decoded are copied then."""
         self.reset()
         self.file = fileOrStream
+        self.useMmap = useMmap
     
     def parse(self):
         return self.readRoot()
@@ -179,44 +338,122 @@ class PlistReader(object):
         self.trailer = None
         self.contents = ''
         self.offsets = []
+        self.objects = []
         self.currentOffset = 0
     
+    def mapContents(self):
+        """Returns a read-only mmap of the file, or None if it cannot be
+           mapped (e.g. for in-memory streams)."""
+        try:
+            return mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, ValueError, EnvironmentError):
+            return None
+    
     def readRoot(self):
         result = None
+        mapped = self.loadContents()
+        try:
+            try:
+                result = self.readObjectNumber(self.trailer.topLevelObjectNumber)
+            except TypeError as e:
+                raise InvalidPlistException(e)
+        finally:
+            self.unloadContents(mapped)
+        return result
+    
+    def loadContents(self):
+        """Reads or maps the file and decodes the trailer and the offset
+           table. Returns the mmap, which must be passed to
+           unloadContents, or None."""
         self.reset()
         # Get the header, make sure it's a valid file.
         if not is_stream_binary_plist(self.file):
             raise NotBinaryPlistException()
         self.file.seek(0)
-        self.contents = self.file.read()
-        if len(self.contents) < 32:
-            raise InvalidPlistException("File is too short.")
-        trailerContents = self.contents[-32:]
+        mapped = self.mapContents() if self.useMmap else None
+        self.contents = mapped if mapped is not None else self.file.read()
         try:
-            self.trailer = PlistTrailer._make(unpack("!xxxxxxBBQQQ", trailerContents))
-            offset_size = self.trailer.offsetSize * self.trailer.offsetCount
-            offset = self.trailer.offsetTableOffset
-            offset_contents = self.contents[offset:offset+offset_size]
-            offset_i = 0
-            while offset_i < self.trailer.offsetCount:
-                begin = self.trailer.offsetSize*offset_i
-                tmp_contents = offset_contents[begin:begin+self.trailer.offsetSize]
-                tmp_sized = self.getSizedInteger(tmp_contents, self.trailer.offsetSize)
-                self.offsets.append(tmp_sized)
-                offset_i += 1
-            self.setCurrentOffsetToObjectNumber(self.trailer.topLevelObjectNumber)
-            result = self.readObject()
-        except TypeError as e:
-            raise InvalidPlistException(e)
-        return result
+            if len(self.contents) < 32:
+                raise InvalidPlistException("File is too short.")
+            try:
+                self.trailer = PlistTrailer._make(unpack_from("!xxxxxxBBQQQ", self.contents, len(self.contents) - 32))
+                self.offsets = self.readSizedIntegers(self.trailer.offsetTableOffset, self.trailer.offsetCount, self.trailer.offsetSize)
+                self.objects = [NotDecoded]*self.trailer.offsetCount
+            except TypeError as e:
+                raise InvalidPlistException(e)
+        except:
+            self.unloadContents(mapped)
+            raise
+        return mapped
+    
+    def unloadContents(self, mapped):
+        if mapped is not None:
+            self.contents = ''
+            mapped.close()
     
     def setCurrentOffsetToObjectNumber(self, objectNumber):
         self.currentOffset = self.offsets[objectNumber]
     
     def readObject(self):
+        """Reads the object at the current offset."""
+        result = self.readMarkedObject()
+        if isinstance(result, ContainerFrame):
+            result = self.readContainers(result)
+        return result
+    
+    def readObjectNumber(self, number):
+        """Reads the object with the given number. Strings, numbers and
+           other immutable objects are decoded only once and shared by all
+           references; arrays, sets and dicts are decoded per reference."""
+        if self.objects[number] is not NotDecoded:
+            return self.objects[number]
+        self.setCurrentOffsetToObjectNumber(number)
+        result = self.readMarkedObject()
+        if isinstance(result, ContainerFrame):
+            result.number = number
+            return self.readContainers(result)
+        self.objects[number] = result
+        return result
+    
+    def readContainers(self, frame):
+        """Decodes the members of frame and of all containers below it
+           with an explicit stack, so deeply nested plists cannot exceed
+           the recursion limit."""
+        stack = [frame]
+        open_numbers = set([frame.number])
+        while True:
+            frame = stack[-1]
+            if len(frame.values) < len(frame.refs):
+                number = frame.refs[len(frame.values)]
+                value = self.objects[number]
+                if value is not NotDecoded:
+                    frame.values.append(value)
+                    continue
+                if number in open_numbers:
+                    raise InvalidPlistException("Object %d contains itself." % number)
+                self.setCurrentOffsetToObjectNumber(number)
+                value = self.readMarkedObject()
+                if isinstance(value, ContainerFrame):
+                    value.number = number
+                    open_numbers.add(number)
+                    stack.append(value)
+                else:
+                    self.objects[number] = value
+                    frame.values.append(value)
+            else:
+                stack.pop()
+                open_numbers.discard(frame.number)
+                value = frame.build()
+                if not stack:
+                    return value
+                stack[-1].values.append(value)
+    
+    def readMarkedObject(self):
+        """Reads the object at the current offset. Instead of decoding
+           the members of arrays, sets and dicts, returns a ContainerFrame
+           with their object refs."""
         result = None
-        tmp_byte = self.contents[self.currentOffset:self.currentOffset+1]
-        marker_byte = unpack("!B", tmp_byte)[0]
+        marker_byte = unpack_from("!B", self.contents, self.currentOffset)[0]
         format = (marker_byte >> 4) & 0x0f
         extra = marker_byte & 0x0f
         self.currentOffset += 1
@@ -224,7 +461,7 @@ class PlistReader(object):
         def proc_extra(extra):
             if extra == 0b1111:
                 #self.currentOffset += 1
-                extra = self.readObject()
+                extra = self.readMarkedObject()
             return extra
         
         # bool, null, or fill byte
@@ -268,77 +505,105 @@ class PlistReader(object):
         # array
         elif format == 0b1010:
             extra = proc_extra(extra)
-            result = self.readArray(extra)
+            result = ContainerFrame('array', self.readRefs(extra))
         # set
         elif format == 0b1100:
             extra = proc_extra(extra)
-            result = set(self.readArray(extra))
+            result = ContainerFrame('set', self.readRefs(extra))
         # dict
         elif format == 0b1101:
             extra = proc_extra(extra)
-            result = self.readDict(extra)
+            result = ContainerFrame('dict', self.readRefs(extra*2))
         else:    
             raise InvalidPlistException("Invalid object found: {format: %s, extra: %s}" % (bin(format), bin(extra)))
         return result
     
+    def readObjectSize(self, number):
+        """Returns the size in bytes of the object with the given number
+           and, for arrays, sets and dicts, the object refs of its members.
+           The object itself is not decoded."""
+        offset = self.offsets[number]
+        marker_byte = unpack_from("!B", self.contents, offset)[0]
+        format = (marker_byte >> 4) & 0x0f
+        extra = marker_byte & 0x0f
+        size = 1
+        refs = ()
+        if format in (0b0100, 0b0101, 0b0110, 0b1010, 0b1100, 0b1101) and extra == 0b1111:
+            int_marker = unpack_from("!B", self.contents, offset + 1)[0]
+            int_bytes = pow(2, int_marker & 0x0f)
+            extra = self.readSizedInteger(offset + 2, int_bytes)
+            size += 1 + int_bytes
+        refSize = self.trailer.objectRefSize
+        if format == 0b0000:
+            pass
+        elif format in (0b0001, 0b0010):
+            size += pow(2, extra)
+        elif format == 0b0011:
+            size += 8
+        elif format in (0b0100, 0b0101):
+            size += extra
+        elif format == 0b0110:
+            size += 2*extra
+        elif format == 0b1000:
+            size += extra + 1
+        elif format in (0b1010, 0b1100):
+            refs = self.readSizedIntegers(offset + size, extra, refSize)
+            size += extra*refSize
+        elif format == 0b1101:
+            refs = self.readSizedIntegers(offset + size, 2*extra, refSize)
+            size += 2*extra*refSize
+        else:
+            raise InvalidPlistException("Invalid object found: {format: %s, extra: %s}" % (bin(format), bin(extra)))
+        return (size, refs)
+    
+    def readReachableSize(self, numbers):
+        """Returns the total size in bytes of the objects with the given
+           numbers and of all objects reachable from them, each counted
+           once."""
+        seen = bytearray(len(self.offsets))
+        stack = list(numbers)
+        total = 0
+        while stack:
+            number = stack.pop()
+            if seen[number]:
+                continue
+            seen[number] = 1
+            (size, refs) = self.readObjectSize(number)
+            total += size
+            stack.extend(refs)
+        return total
+    
     def readInteger(self, bytes):
-        result = 0
-        original_offset = self.currentOffset
-        data = self.contents[self.currentOffset:self.currentOffset+bytes]
-        result = self.getSizedInteger(data, bytes)
-        self.currentOffset = original_offset + bytes
+        result = self.readSizedInteger(self.currentOffset, bytes)
+        self.currentOffset += bytes
         return result
     
     def readReal(self, length):
         result = 0.0
         to_read = pow(2, length)
-        data = self.contents[self.currentOffset:self.currentOffset+to_read]
         if length == 2: # 4 bytes
-            result = unpack('>f', data)[0]
+            result = unpack_from('>f', self.contents, self.currentOffset)[0]
         elif length == 3: # 8 bytes
-            result = unpack('>d', data)[0]
+            result = unpack_from('>d', self.contents, self.currentOffset)[0]
         else:
             raise InvalidPlistException("Unknown real of length %d bytes" % to_read)
         return result
     
     def readRefs(self, count):    
-        refs = []
-        i = 0
-        while i < count:
-            fragment = self.contents[self.currentOffset:self.currentOffset+self.trailer.objectRefSize]
-            ref = self.getSizedInteger(fragment, len(fragment))
-            refs.append(ref)
-            self.currentOffset += self.trailer.objectRefSize
-            i += 1
+        refs = self.readSizedIntegers(self.currentOffset, count, self.trailer.objectRefSize)
+        self.currentOffset += count*self.trailer.objectRefSize
         return refs
     
     def readArray(self, count):
-        result = []
-        values = self.readRefs(count)
-        i = 0
-        while i < len(values):
-            self.setCurrentOffsetToObjectNumber(values[i])
-            value = self.readObject()
-            result.append(value)
-            i += 1
-        return result
+        return self.readContainers(ContainerFrame('array', self.readRefs(count)))
     
     def readDict(self, count):
-        result = {}
-        keys = self.readRefs(count)
-        values = self.readRefs(count)
-        i = 0
-        while i < len(keys):
-            self.setCurrentOffsetToObjectNumber(keys[i])
-            key = self.readObject()
-            self.setCurrentOffsetToObjectNumber(values[i])
-            value = self.readObject()
-            result[key] = value
-            i += 1
-        return result
+        return self.readContainers(ContainerFrame('dict', self.readRefs(count*2)))
     
     def readAsciiString(self, length):
-        result = unpack("!%ds" % length, self.contents[self.currentOffset:self.currentOffset+length])[0]
+        result = self.contents[self.currentOffset:self.currentOffset+length]
+        if len(result) != length:
+            raise InvalidPlistException("String extends beyond the end of the file.")
         self.currentOffset += length
         return result
     
@@ -351,7 +616,7 @@ class PlistReader(object):
     
     def readDate(self):
         global apple_reference_date_offset
-        result = unpack(">d", self.contents[self.currentOffset:self.currentOffset+8])[0]
+        result = unpack_from(">d", self.contents, self.currentOffset)[0]
         result = datetime.datetime.utcfromtimestamp(result + apple_reference_date_offset)
         self.currentOffset += 8
         return result
@@ -364,6 +629,28 @@ class PlistReader(object):
     def readUid(self, length):
         return Uid(self.readInteger(length+1))
     
+    def readSizedInteger(self, offset, bytes):
+        """Reads an integer of the given size at offset, without slicing
+           the contents."""
+        format = SizedIntegerFormats.get(bytes)
+        if format is None:
+            raise InvalidPlistException("Encountered integer longer than 8 bytes.")
+        return unpack_from(format, self.contents, offset)[0]
+    
+    def readSizedIntegers(self, offset, count, bytes):
+        """Reads count consecutive integers of the given size at offset
+           with a single unpack_from (or numpy.frombuffer for large
+           tables). Returns a list."""
+        format = SizedIntegerFormats.get(bytes)
+        if format is None:
+            raise InvalidPlistException("Encountered integer longer than 8 bytes.")
+        if offset + count*bytes > len(self.contents):
+            raise InvalidPlistException("Integers extend beyond the end of the file.")
+        if count >= NumpyMinimumCount and importNumpy() is not None:
+            dtype = '>i8' if bytes == 8 else '>u%d' % bytes
+            return numpy.frombuffer(self.contents, dtype=dtype, count=count, offset=offset).tolist()
+        return list(unpack_from('>%d%s' % (count, format[1]), self.contents, offset))
+    
     def getSizedInteger(self, data, bytes):
         result = 0
         # 1, 2, and 4 byte integers are unsigned
@@ -379,11 +666,28 @@ class PlistReader(object):
             raise InvalidPlistException("Encountered integer longer than 8 bytes.")
         return result
 
-class HashableWrapper(object):
-    def __init__(self, value):
-        self.value = value
-    def __repr__(self):
-        return "<HashableWrapper: %s>" % [self.value]
+class PlistWriterCounts(object):
+    """Mutable byte counts of a PlistWriter, with the fields of
+       PlistByteCounts."""
+    __slots__ = PlistByteCounts._fields
+    
+    def __init__(self):
+        for field in self.__slots__:
+            setattr(self, field, 0)
+    
+    def asTuple(self):
+        return PlistByteCounts(*[getattr(self, field) for field in self.__slots__])
+
+class PlistWriterTrailer(object):
+    """Mutable trailer of a PlistWriter, with the fields of PlistTrailer."""
+    __slots__ = PlistTrailer._fields
+    
+    def __init__(self):
+        for field in self.__slots__:
+            setattr(self, field, 0)
+    
+    def asTuple(self):
+        return PlistTrailer(*[getattr(self, field) for field in self.__slots__])
 
 class BoolWrapper(object):
     def __init__(self, value):
@@ -397,8 +701,14 @@ class PlistWriter(object):
     byteCounts = None
     trailer = None
     computedUniques = None
+    computedContainers = 0
     writtenReferences = None
     referencePositions = None
+    referenceFormat = None
+    writtenObjects = None
+    containerPositions = None
+    numberBase = 0
+    positionBase = 0
     wrappedTrue = None
     wrappedFalse = None
     
@@ -409,89 +719,82 @@ class PlistWriter(object):
         self.wrappedFalse = BoolWrapper(False)
 
     def reset(self):
-        self.byteCounts = PlistByteCounts(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
-        self.trailer = PlistTrailer(0, 0, 0, 0, 0)
+        self.byteCounts = PlistWriterCounts()
+        self.trailer = PlistWriterTrailer()
         
-        # A set of all the uniques which have been computed.
+        # A set of all the unique scalars which have been computed.
         self.computedUniques = set()
-        # A list of all the uniques which have been written.
+        # The number of arrays, sets and dicts which have been computed.
+        # Containers are never shared, every occurrence is a new object.
+        self.computedContainers = 0
+        # A dict of the reference numbers of the written scalars.
         self.writtenReferences = {}
-        # A dict of the positions of the written uniques.
+        # A dict of the positions of the written scalars.
         self.referencePositions = {}
+        # The written objects, in the order of their reference numbers.
+        self.writtenObjects = []
+        # A dict of the positions of the written containers, by number.
+        self.containerPositions = {}
+        # Reference number and position of the first object written; not 0
+        # when appending to an existing plist.
+        self.numberBase = 0
+        self.positionBase = 0
+    
+    def isContainer(self, obj):
+        return isinstance(obj, (set, list, tuple, dict))
+    
+    def referenceKey(self, obj):
+        """Returns the key under which a scalar is shared. Booleans must not
+           be shared with the equal integers 0 and 1."""
+        if obj is True:
+            return self.wrappedTrue
+        elif obj is False:
+            return self.wrappedFalse
+        return obj
         
     def positionOfObjectReference(self, obj):
         """If the given object has been written already, return its
            position in the offset table. Otherwise, return None."""
-        return self.writtenReferences.get(obj)
+        return self.writtenReferences.get(self.referenceKey(obj))
         
     def writeRoot(self, root):
         """
         Strategy is:
         - write header
-        - wrap root object so everything is hashable
-        - compute size of objects which will be written
+        - compute the number of unique objects which will be written
           - need to do this in order to know how large the object refs
             will be in the list/dict/set reference lists
-        - write objects
-          - keep objects in writtenReferences
+        - write objects into a single bytearray
+          - keep scalars in writtenReferences
           - keep positions of object references in referencePositions
           - write object references with the length computed previously
         - computer object reference length
         - write object reference positions
         - write trailer
         """
-        output = self.header
-        wrapped_root = self.wrapRoot(root)
-        should_reference_root = True#not isinstance(wrapped_root, HashableWrapper)
-        self.computeOffsets(wrapped_root, asReference=should_reference_root, isRoot=True)
-        self.trailer = self.trailer._replace(**{'objectRefSize':self.intSize(len(self.computedUniques))})
-        (_, output) = self.writeObjectReference(wrapped_root, output)
-        output = self.writeObject(wrapped_root, output, setReferencePosition=True)
+        output = bytearray(self.header)
+        self.computeOffsets(root, asReference=True, isRoot=True)
+        self.trailer.objectRefSize = self.intSize(len(self.computedUniques) + self.computedContainers)
+        self.referenceFormat = SizedIntegerFormats[self.trailer.objectRefSize]
+        (_, output) = self.writeObjectReference(root, output)
+        output = self.writeObject(root, output, setReferencePosition=True)
         
         # output size at this point is an upper bound on how big the
         # object reference offsets need to be.
-        self.trailer = self.trailer._replace(**{
-            'offsetSize':self.intSize(len(output)),
-            'offsetCount':len(self.computedUniques),
-            'offsetTableOffset':len(output),
-            'topLevelObjectNumber':0
-            })
+        self.trailer.offsetSize = self.intSize(len(output))
+        self.trailer.offsetCount = len(self.writtenObjects)
+        self.trailer.offsetTableOffset = len(output)
+        self.trailer.topLevelObjectNumber = 0
         
         output = self.writeOffsetTable(output)
-        output += pack('!xxxxxxBBQQQ', *self.trailer)
-        self.file.write(output)
-
-    def wrapRoot(self, root):
-        if isinstance(root, bool):
-            if root is True:
-                return self.wrappedTrue
-            else:
-                return self.wrappedFalse
-        elif isinstance(root, set):
-            n = set()
-            for value in root:
-                n.add(self.wrapRoot(value))
-            return HashableWrapper(n)
-        elif isinstance(root, dict):
-            n = {}
-            for key, value in six.iteritems(root):
-                n[self.wrapRoot(key)] = self.wrapRoot(value)
-            return HashableWrapper(n)
-        elif isinstance(root, list):
-            n = []
-            for value in root:
-                n.append(self.wrapRoot(value))
-            return HashableWrapper(n)
-        elif isinstance(root, tuple):
-            n = tuple([self.wrapRoot(value) for value in root])
-            return HashableWrapper(n)
-        else:
-            return root
+        output += pack('!xxxxxxBBQQQ', *self.trailer.asTuple())
+        self.file.write(bytes(output))
 
     def incrementByteCount(self, field, incr=1):
-        self.byteCounts = self.byteCounts._replace(**{field:self.byteCounts.__getattribute__(field) + incr})
+        setattr(self.byteCounts, field, getattr(self.byteCounts, field) + incr)
 
     def computeOffsets(self, obj, asReference=False, isRoot=False):
+        """Counts the unique objects below obj, without recursion."""
         def check_key(key):
             if key is None:
                 raise InvalidPlistException('Dictionary keys cannot be null in plists.')
@@ -504,99 +807,179 @@ class PlistWriter(object):
             if size > 0b1110:
                 size += self.intSize(size)
             return size
-        # If this should be a reference, then we keep a record of it in the
-        # uniques table.
-        if asReference:
-            if obj in self.computedUniques:
-                return
-            else:
-                self.computedUniques.add(obj)
         
-        if obj is None:
-            self.incrementByteCount('nullBytes')
-        elif isinstance(obj, BoolWrapper):
-            self.incrementByteCount('boolBytes')
-        elif isinstance(obj, Uid):
-            size = self.intSize(obj)
-            self.incrementByteCount('uidBytes', incr=1+size)
-        elif isinstance(obj, six.integer_types):
-            size = self.intSize(obj)
-            self.incrementByteCount('intBytes', incr=1+size)
-        elif isinstance(obj, (float)):
-            size = self.realSize(obj)
-            self.incrementByteCount('realBytes', incr=1+size)
-        elif isinstance(obj, datetime.datetime):    
-            self.incrementByteCount('dateBytes', incr=2)
-        elif isinstance(obj, Data):
-            size = proc_size(len(obj))
-            self.incrementByteCount('dataBytes', incr=1+size)
-        elif isinstance(obj, (six.text_type, six.binary_type)):
-            size = proc_size(len(obj))
-            self.incrementByteCount('stringBytes', incr=1+size)
-        elif isinstance(obj, HashableWrapper):
-            obj = obj.value
-            if isinstance(obj, set):
-                size = proc_size(len(obj))
-                self.incrementByteCount('setBytes', incr=1+size)
-                for value in obj:
-                    self.computeOffsets(value, asReference=True)
-            elif isinstance(obj, (list, tuple)):
+        counts = self.byteCounts
+        uniques = self.computedUniques
+        stack = [(obj, asReference)]
+        while stack:
+            (obj, asReference) = stack.pop()
+            # If this should be a reference, then we keep a record of it in the
+            # uniques table.
+            if asReference and not self.isContainer(obj):
+                key = self.referenceKey(obj)
+                if key in uniques:
+                    continue
+                else:
+                    uniques.add(key)
+            
+            if obj is None:
+                counts.nullBytes += 1
+            elif isinstance(obj, bool):
+                counts.boolBytes += 1
+            elif isinstance(obj, Uid):
+                size = self.intSize(obj)
+                counts.uidBytes += 1+size
+            elif isinstance(obj, six.integer_types):
+                size = self.intSize(obj)
+                counts.intBytes += 1+size
+            elif isinstance(obj, (float)):
+                size = self.realSize(obj)
+                counts.realBytes += 1+size
+            elif isinstance(obj, datetime.datetime):    
+                counts.dateBytes += 2
+            elif isinstance(obj, Data):
                 size = proc_size(len(obj))
-                self.incrementByteCount('arrayBytes', incr=1+size)
-                for value in obj:
-                    asRef = True
-                    self.computeOffsets(value, asReference=True)
-            elif isinstance(obj, dict):
+                counts.dataBytes += 1+size
+            elif isinstance(obj, (six.text_type, six.binary_type)):
                 size = proc_size(len(obj))
-                self.incrementByteCount('dictBytes', incr=1+size)
-                for key, value in six.iteritems(obj):
-                    check_key(key)
-                    self.computeOffsets(key, asReference=True)
-                    self.computeOffsets(value, asReference=True)
-        else:
-            raise InvalidPlistException("Unknown object type.")
+                counts.stringBytes += 1+size
+            elif self.isContainer(obj):
+                if asReference:
+                    self.computedContainers += 1
+                if isinstance(obj, set):
+                    size = proc_size(len(obj))
+                    counts.setBytes += 1+size
+                    for value in obj:
+                        stack.append((value, True))
+                elif isinstance(obj, (list, tuple)):
+                    size = proc_size(len(obj))
+                    counts.arrayBytes += 1+size
+                    for value in obj:
+                        stack.append((value, True))
+                elif isinstance(obj, dict):
+                    size = proc_size(len(obj))
+                    counts.dictBytes += 1+size
+                    for key, value in six.iteritems(obj):
+                        check_key(key)
+                        stack.append((key, True))
+                        stack.append((value, True))
+            else:
+                raise InvalidPlistException("Unknown object type.")
 
     def writeObjectReference(self, obj, output):
         """Tries to write an object reference, adding it to the references
            table. Does not write the actual object bytes or set the reference
            position. Returns a tuple of whether the object was a new reference
            (True if it was, False if it already was in the reference table)
-           and the new output.
+           and the new output. Containers are always new references.
         """
-        position = self.positionOfObjectReference(obj)
+        container = self.isContainer(obj)
+        if container:
+            position = None
+        else:
+            position = self.positionOfObjectReference(obj)
         if position is None:
-            self.writtenReferences[obj] = len(self.writtenReferences)
-            output += self.binaryInt(len(self.writtenReferences) - 1, bytes=self.trailer.objectRefSize)
+            number = self.numberBase + len(self.writtenObjects)
+            if not container:
+                self.writtenReferences[self.referenceKey(obj)] = number
+            self.writtenObjects.append(obj)
+            output += pack(self.referenceFormat, number)
             return (True, output)
         else:
-            output += self.binaryInt(position, bytes=self.trailer.objectRefSize)
+            output += pack(self.referenceFormat, position)
             return (False, output)
 
-    def writeObject(self, obj, output, setReferencePosition=False):
+    def writeObject(self, obj, output, setReferencePosition=False, number=None):
         """Serializes the given object to the output. Returns output.
            If setReferencePosition is True, will set the position the
-           object was written.
+           object was written. The reference number of a container defaults
+           to the last reference written. Members of containers are written
+           with an explicit stack instead of recursion.
         """
-        def proc_variable_length(format, length):
-            result = six.b('')
-            if length > 0b1110:
-                result += pack('!B', (format << 4) | 0b1111)
-                result = self.writeObject(length, result)
+        if number is None:
+            number = self.numberBase + len(self.writtenObjects) - 1
+        stack = [iter([(obj, number)])]
+        while stack:
+            try:
+                (obj, number) = next(stack[-1])
+            except StopIteration:
+                stack.pop()
+                continue
+            if not self.isContainer(obj):
+                output = self.writeScalar(obj, output, setReferencePosition)
+                setReferencePosition = True
+                continue
+            
+            if setReferencePosition:
+                self.containerPositions[number] = self.positionBase + len(output)
+            setReferencePosition = True
+            if isinstance(obj, dict):
+                output += self.binaryLength(0b1101, len(obj))
+                if not six.PY3:
+                    # Python 2 dicts iterate in the order of their hash
+                    # table. Earlier versions wrote a copy of every dict,
+                    # so iterate a copy built the same way to keep the
+                    # output identical.
+                    obj = dict(six.iteritems(obj))
+                keys = []
+                values = []
+                for key, value in six.iteritems(obj):
+                    keys.append(key)
+                    values.append(value)
+                members = keys + values
             else:
-                result += pack('!B', (format << 4) | length)
-            return result
-        
+                if isinstance(obj, set):
+                    output += self.binaryLength(0b1100, len(obj))
+                else:
+                    output += self.binaryLength(0b1010, len(obj))
+                members = obj
+            
+            objectsToWrite = []
+            for objRef in members:
+                (isNew, output) = self.writeObjectReference(objRef, output)
+                if isNew:
+                    objectsToWrite.append((objRef, self.numberBase + len(self.writtenObjects) - 1))
+            stack.append(iter(objectsToWrite))
+        return output
+    
+    def writeValues(self, values, output):
+        """Writes each of values as an object, without writing references
+           to them. Returns a tuple of the reference numbers of values and
+           the new output. Used to append objects to an existing plist."""
+        numbers = []
+        for value in values:
+            (isNew, _) = self.writeObjectReference(value, bytearray())
+            if isNew:
+                number = self.numberBase + len(self.writtenObjects) - 1
+                output = self.writeObject(value, output, setReferencePosition=True, number=number)
+            else:
+                number = self.positionOfObjectReference(value)
+            numbers.append(number)
+        return (numbers, output)
+    
+    def binaryLength(self, format, length):
+        result = six.b('')
+        if length > 0b1110:
+            result += pack('!B', (format << 4) | 0b1111)
+            result = self.writeScalar(length, result)
+        else:
+            result += pack('!B', (format << 4) | length)
+        return result
+    
+    def writeScalar(self, obj, output, setReferencePosition=False):
+        """Serializes the given object, which must not be a container, to
+           the output. Returns output."""
         if isinstance(obj, six.text_type) and obj == six.u(''):
             # The Apple Plist decoder can't decode a zero length Unicode string.
             obj = six.b('')
        
         if setReferencePosition:
-            self.referencePositions[obj] = len(output)
+            self.referencePositions[self.referenceKey(obj)] = self.positionBase + len(output)
         
         if obj is None:
             output += pack('!B', 0b00000000)
-        elif isinstance(obj, BoolWrapper):
-            if obj.value is False:
+        elif isinstance(obj, bool):
+            if obj is False:
                 output += pack('!B', 0b00001000)
             else:
                 output += pack('!B', 0b00001001)
@@ -619,69 +1002,31 @@ class PlistWriter(object):
             output += pack('!B', 0b00110011)
             output += pack('!d', float(timestamp))
         elif isinstance(obj, Data):
-            output += proc_variable_length(0b0100, len(obj))
+            output += self.binaryLength(0b0100, len(obj))
             output += obj
         elif isinstance(obj, six.text_type):
             bytes = obj.encode('utf_16_be')
-            output += proc_variable_length(0b0110, len(bytes)//2)
+            output += self.binaryLength(0b0110, len(bytes)//2)
             output += bytes
         elif isinstance(obj, six.binary_type):
             bytes = obj
-            output += proc_variable_length(0b0101, len(bytes))
+            output += self.binaryLength(0b0101, len(bytes))
             output += bytes
-        elif isinstance(obj, HashableWrapper):
-            obj = obj.value
-            if isinstance(obj, (set, list, tuple)):
-                if isinstance(obj, set):
-                    output += proc_variable_length(0b1100, len(obj))
-                else:
-                    output += proc_variable_length(0b1010, len(obj))
-            
-                objectsToWrite = []
-                for objRef in obj:
-                    (isNew, output) = self.writeObjectReference(objRef, output)
-                    if isNew:
-                        objectsToWrite.append(objRef)
-                for objRef in objectsToWrite:
-                    output = self.writeObject(objRef, output, setReferencePosition=True)
-            elif isinstance(obj, dict):
-                output += proc_variable_length(0b1101, len(obj))
-                keys = []
-                values = []
-                objectsToWrite = []
-                for key, value in six.iteritems(obj):
-                    keys.append(key)
-                    values.append(value)
-                for key in keys:
-                    (isNew, output) = self.writeObjectReference(key, output)
-                    if isNew:
-                        objectsToWrite.append(key)
-                for value in values:
-                    (isNew, output) = self.writeObjectReference(value, output)
-                    if isNew:
-                        objectsToWrite.append(value)
-                for objRef in objectsToWrite:
-                    output = self.writeObject(objRef, output, setReferencePosition=True)
         return output
     
     def writeOffsetTable(self, output):
         """Writes all of the object reference offsets."""
-        all_positions = []
-        writtenReferences = list(self.writtenReferences.items())
-        writtenReferences.sort(key=lambda x: x[1])
-        for obj,order in writtenReferences:
-            # Porting note: Elsewhere we deliberately replace empty unicdoe strings
-            # with empty binary strings, but the empty unicode string
-            # goes into writtenReferences.  This isn't an issue in Py2
-            # because u'' and b'' have the same hash; but it is in
-            # Py3, where they don't.
-            if six.PY3 and obj == six.u(''):
-                obj = six.b('')
-            position = self.referencePositions.get(obj)
+        for number, obj in enumerate(self.writtenObjects):
+            position = self.containerPositions.get(self.numberBase + number)
+            if position is None and not self.isContainer(obj):
+                # Empty unicode strings are written as empty binary strings.
+                # In Py3 they do not compare equal.
+                if isinstance(obj, six.text_type) and obj == six.u(''):
+                    obj = six.b('')
+                position = self.referencePositions.get(self.referenceKey(obj))
             if position is None:
                 raise InvalidPlistException("Error while writing offsets table. Object not found. %s" % obj)
             output += self.binaryInt(position, self.trailer.offsetSize)
-            all_positions.append(position)
         return output
     
     def binaryReal(self, obj):
@@ -4,15 +4,18 @@ import json
 import os
 import alp.core as core
 import codecs
+from contextlib import contextmanager
 
 
 class Settings(object):
-    def __init__(self):
+    def __init__(self, fsync=False):
         self._settingsPath = core.storage("settings.json")
+        self._fsync = fsync
+        self._batches = 0
+        self._dirty = False
         if not os.path.exists(self._settingsPath):
             blank = {}
-            with codecs.open(self._settingsPath, "w", "utf-8") as f:
-                json.dump(blank, f)
+            core.jsonDump(blank, self._settingsPath, fsync=self._fsync)
             self._loadedSettings = blank
         else:
             with codecs.open(self._settingsPath, "r", "utf-8") as f:
@@ -22,8 +25,7 @@ class Settings(object):
     def set(self, **kwargs):
         for (k, v) in kwargs.iteritems():
             self._loadedSettings[k] = v
-        with codecs.open(self._settingsPath, "w", "utf-8") as f:
-            json.dump(self._loadedSettings, f)
+        self._changed()
 
     def get(self, k, default=None):
         try:
@@ -34,5 +36,34 @@ class Settings(object):
     def delete(self, k):
         if k in self._loadedSettings.keys():
             self._loadedSettings.pop(k)
-            with codecs.open(self._settingsPath, "w", "utf-8") as f:
-                json.dump(self._loadedSettings, f)
+            self._changed()
+
+    def _changed(self):
+        self._dirty = True
+        if not self._batches:
+            self.flush()
+
+    def flush(self):
+        # Writes the settings, if they changed since the last write
+        if self._dirty:
+            core.jsonDump(self._loadedSettings, self._settingsPath,
+                          fsync=self._fsync)
+            self._dirty = False
+
+    @contextmanager
+    def batch(self):
+        # Changes inside the block are written once the outermost batch
+        # ends. If a block raises, the changes made inside it are discarded,
+        # also when it is nested in a batch that carries on.
+        saved = (dict(self._loadedSettings), self._dirty)
+        done = False
+        self._batches += 1
+        try:
+            yield self
+            done = True
+        finally:
+            self._batches -= 1
+            if not done:
+                self._loadedSettings, self._dirty = saved
+        if not self._batches:
+            self.flush()
@@ -12,15 +12,45 @@ Mac OS X. An installable object is any of the following:
 """
 
 import os.path
+import argparse
+import atexit
+import ctypes
+import ctypes.util
+import hashlib
+import io
+import json
 import logging
 import logging.handlers
+import multiprocessing
+import plistlib
+import shutil
+import stat
+import struct
 import zipfile
 import errno
 import subprocess
+import sys
 import tempfile
+import threading
+import time
 
 import send2trash
 
+from alp.core_dependencies import biplist
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 __author__ = "Franz Greiling"
 __email__ = "dev.installpy@lc3dyr.de"
 __copyright__ = "Copyright (c) 2014, Franz Greiling"
@@ -28,6 +58,35 @@ __licence__ = "BSD 2-Clause License"
 __version__ = "v1.0"
 
 
+#: Buffer size for streaming file contents
+_BUFSIZE = 1024 * 1024
+
+
+# copyfile(3) on Mac OS X clones files on APFS and copies all metadata,
+# including extended attributes and ACLs
+_COPYFILE_ALL = 0xF
+_COPYFILE_METADATA = 0x7
+_COPYFILE_NOFOLLOW = 0xC0000
+_COPYFILE_CLONE = 0x1000000
+
+# renamex_np(2) on Mac OS X and renameat2(2) on Linux exchange two paths
+# atomically
+_RENAME_SWAP = 0x2
+_RENAME_EXCHANGE = 0x2
+_AT_FDCWD = -100
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+
+_copyfile = None
+if sys.platform == 'darwin' and hasattr(_libc, 'copyfile'):
+    _copyfile = _libc.copyfile
+    _copyfile.argtypes = [ctypes.c_char_p, ctypes.c_char_p,
+                          ctypes.c_void_p, ctypes.c_uint32]
+
+
 # Setting up Logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -50,39 +109,1348 @@ logger.addHandler(syslog)
 # logger.addHandler(console)
 
 
-def mount_dmg(dmg, unmount=False):
-    """ (Un)Mounts given DMG at /Volumes/NAME """
+def _quick_digest(path):
+    """
+    Returns a digest of the size and the first and last block of path
+
+    Cheap enough for multi-GB images, while still telling apart two images
+    replacing each other at the same path.
+    """
+    digest = hashlib.sha256()
+
+    # Directories stand in for images with DirectoryBackend
+    if os.path.isdir(path):
+        st = os.stat(path)
+        digest.update(repr((st.st_ino, st.st_mtime)).encode('ascii'))
+        return digest.hexdigest()
+
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        size = f.tell()
+        digest.update(str(size).encode('ascii'))
+        f.seek(0)
+        digest.update(f.read(65536))
+        f.seek(max(0, size - 65536))
+        digest.update(f.read(65536))
+    return digest.hexdigest()
+
+
+def _read_plist(data):
+    """ Parses the XML plist data """
+    if hasattr(plistlib, 'loads'):
+        return plistlib.loads(data)
+    return plistlib.readPlistFromString(data)
+
+
+def _bundle_version(path):
+    """
+    Returns [CFBundleShortVersionString, CFBundleVersion] of the bundle at
+    path, or None if its Info.plist cannot be read
+    """
+    for name in ('Contents/Info.plist', 'Info.plist'):
+        # plistlib cannot parse binary plists on Python 2, biplist reads both
+        try:
+            info = biplist.readPlist(os.path.join(path, name))
+        except (IOError, OSError):
+            continue
+        except Exception:
+            logger.debug("Could not parse %s" % os.path.join(path, name))
+            return None
+
+        return [info.get('CFBundleShortVersionString'),
+                info.get('CFBundleVersion')]
+
+    return None
+
+
+class DiskImageBackend(object):
+    """
+    Interface to attach and detach Disk Images, used by MountManager.
+    """
+
+    def attach(self, image, mountpoint):
+        """ Attaches image at mountpoint, raises OSError on failure """
+        raise NotImplementedError()
+
+    def detach(self, mountpoint):
+        """ Detaches the image at mountpoint, raises OSError on failure """
+        raise NotImplementedError()
 
-    # Generate Mountpoint
-    mount_point = os.path.join('/Volumes/',
-                               os.path.splitext(os.path.basename(dmg))[0])
+    def attached(self):
+        """ Returns a dict of all attached images and their mountpoints """
+        raise NotImplementedError()
 
-    # Mount dmg
-    dnull = open('/dev/null', 'w')
+    def contents(self, mountpoint):
+        """ Returns the names of the entries at the root of mountpoint """
+        return os.listdir(mountpoint)
+
+
+class HdiutilBackend(DiskImageBackend):
+    """
+    Attaches Disk Images with hdiutil.
+
+    Commands are lists of arguments, in which '{image}' and '{mountpoint}'
+    are replaced. Pointing them at a stand-in script allows testing without
+    hdiutil.
+    """
+
+    #: Command attaching {image} at {mountpoint}
+    ATTACH = ['hdiutil', 'attach', '-mountpoint', '{mountpoint}', '{image}']
+
+    #: Command detaching {mountpoint}
+    DETACH = ['hdiutil', 'detach', '{mountpoint}']
+
+    #: Command printing the attached images as plist
+    INFO = ['hdiutil', 'info', '-plist']
+
+    def __init__(self, attach=ATTACH, detach=DETACH, info=INFO):
+        """
+        Args:
+            attach, detach: Commands attaching and detaching an image.
+                Default to ATTACH and DETACH
+            info: Command listing the attached images, None to not look for
+                images attached by others. Defaults to INFO
+        """
+        self.attach_command = attach
+        self.detach_command = detach
+        self.info_command = info
+
+    def _run(self, command, image, mountpoint):
+        args = [a.format(image=image, mountpoint=mountpoint)
+                for a in command]
+
+        dnull = open(os.devnull, 'w')
+        try:
+            return_code = subprocess.call(args, stdout=dnull)
+        finally:
+            dnull.close()
+
+        # Minimal Error Handling
+        if return_code != 0:
+            logger.error("%d: %s" %
+                         (return_code, errno.errorcode.get(return_code)))
+            raise OSError(return_code)
+
+    def attach(self, image, mountpoint):
+        self._run(self.attach_command, image, mountpoint)
+
+    def detach(self, mountpoint):
+        self._run(self.detach_command, '', mountpoint)
+
+    def attached(self):
+        if not self.info_command:
+            return {}
+
+        try:
+            info = _read_plist(subprocess.check_output(self.info_command))
+        except (OSError, subprocess.CalledProcessError, ValueError) as e:
+            logger.debug("Could not list attached images: %s" % e)
+            return {}
+
+        images = {}
+        for i in info.get('images', []):
+            for entity in i.get('system-entities', []):
+                if 'mount-point' in entity:
+                    image = os.path.realpath(i.get('image-path', ''))
+                    images[image] = entity['mount-point']
+
+        return images
+
+
+class DirectoryBackend(DiskImageBackend):
+    """
+    Stand-in for hdiutil, backing Disk Images by plain directories.
+
+    An image is attached by symlinking its directory to the mountpoint. The
+    directory is looked up in volumes, or is the image itself if that is a
+    directory. With latency set, attaching and detaching are delayed to
+    mimic hdiutil, so the mount overhead of an install can be measured on
+    any platform.
+    """
+
+    def __init__(self, volumes=None, latency=0.0):
+        """
+        Args:
+            volumes: dict of image paths and the directories backing them.
+                Defaults to None
+            latency: Seconds each attach and detach takes.
+                Defaults to 0.0
+        """
+        self.volumes = dict((os.path.realpath(k), v)
+                            for k, v in (volumes or {}).items())
+        self.latency = latency
+        self._attached = {}
+
+    def attach(self, image, mountpoint):
+        volume = self.volumes.get(image, image)
+        if not os.path.isdir(volume):
+            raise OSError(errno.ENOENT, "No volume for image", image)
+
+        time.sleep(self.latency)
+        os.symlink(os.path.abspath(volume), mountpoint)
+        self._attached[image] = mountpoint
+
+    def detach(self, mountpoint):
+        time.sleep(self.latency)
+        os.remove(mountpoint)
+        for image, m in list(self._attached.items()):
+            if m == mountpoint:
+                del self._attached[image]
+
+    def attached(self):
+        return dict(self._attached)
+
+
+class MountManager(object):
+    """
+    Attaches Disk Images and keeps track of them.
+
+    Images are identified by their path and a quick checksum. Attaching an
+    image that is attached already reuses the mount and increases its
+    reference count. When the last reference is released, the image is
+    detached after 'idle' seconds, unless it is attached again before.
+    Images that were attached by someone else are reused, but never
+    detached. Attached images are only reused while their checksum matches
+    the one they had when the mount was first seen, so an image replaced at
+    the same path is attached fresh.
+
+    The time spent attaching and detaching is accumulated, so the mount
+    overhead of installs can be measured.
+    """
+
+    #: Seconds after which released images are detached
+    IDLE = 30
+
+    def __init__(self, backend=None, root='/Volumes/', idle=IDLE):
+        """
+        Args:
+            backend: DiskImageBackend attaching the images.
+                Defaults to HdiutilBackend()
+            root: Directory in which mountpoints are created.
+                Defaults to '/Volumes/'
+            idle: Seconds after which released images are detached.
+                Defaults to IDLE
+        """
+        self.backend = backend if backend is not None else HdiutilBackend()
+        self.root = root
+        self.idle = idle
+        self.attach_seconds = 0.0
+        self.detach_seconds = 0.0
+        self._mounts = {}
+        self._digests = {}
+        self._lock = threading.RLock()
+
+    def _mountpoint(self, image):
+        """ Returns a free mountpoint named after image """
+        base = os.path.join(self.root,
+                            os.path.splitext(os.path.basename(image))[0])
+        used = set(m['mountpoint'] for m in self._mounts.values())
+
+        mountpoint, n = base, 1
+        while mountpoint in used or os.path.lexists(mountpoint):
+            mountpoint = "%s %d" % (base, n)
+            n += 1
+
+        return mountpoint
+
+    def _find(self, image):
+        """ Returns the key of the tracked mount of image """
+        image = os.path.realpath(image)
+        keys = [k for k in self._mounts if k[0] == image]
+
+        if len(keys) > 1:
+            try:
+                keys = [k for k in keys if k[1] == _quick_digest(image)]
+            except (IOError, OSError):
+                pass
+
+        return keys[0] if keys else None
+
+    def acquire(self, image):
+        """
+        Attaches image, or reuses the mount if it is attached already.
+
+        Returns:
+            the mountpoint of image.
+
+        Raises:
+            OSError: if attaching image failed.
+        """
+        real = os.path.realpath(image)
+        key = (real, _quick_digest(real))
+
+        with self._lock:
+            mount = self._mounts.get(key)
+
+            if mount is None:
+                mountpoint = self.backend.attached().get(real)
+
+                # Attachments are only known by path, so remember which
+                # version of the image was seen at each of them
+                seen = self._digests.get((real, mountpoint), key[1])
+                if mountpoint is not None and seen != key[1]:
+                    logger.info("%s changed since it was mounted at %s" %
+                                (image, mountpoint))
+                    mountpoint = None
+
+                owned = mountpoint is None
+                if owned:
+                    mountpoint = self._mountpoint(real)
+                    start = time.time()
+                    try:
+                        self.backend.attach(real, mountpoint)
+                    finally:
+                        self.attach_seconds += time.time() - start
+                    logger.info("Mounted %s at %s" % (image, mountpoint))
+                else:
+                    logger.info("Reusing %s at %s" % (image, mountpoint))
+
+                mount = {'mountpoint': mountpoint, 'refs': 0,
+                         'owned': owned, 'timer': None}
+                self._mounts[key] = mount
+                self._digests[(real, mountpoint)] = key[1]
+
+            if mount['timer'] is not None:
+                mount['timer'].cancel()
+                mount['timer'] = None
+
+            mount['refs'] += 1
+            return mount['mountpoint']
+
+    def release(self, image):
+        """
+        Releases a reference to image acquired before.
+
+        Raises:
+            OSError: if detaching image failed.
+        """
+        with self._lock:
+            key = self._find(image)
+            if key is None:
+                logger.warning("%s is not mounted" % image)
+                return
+
+            mount = self._mounts[key]
+            mount['refs'] -= 1
+            if mount['refs'] > 0:
+                return
+
+            if not mount['owned']:
+                del self._mounts[key]
+            elif self.idle:
+                mount['timer'] = threading.Timer(self.idle, self._expire,
+                                                 [key])
+                mount['timer'].daemon = True
+                mount['timer'].start()
+            else:
+                self._detach(key)
+
+    def _expire(self, key):
+        with self._lock:
+            mount = self._mounts.get(key)
+            if mount is not None and mount['refs'] == 0:
+                try:
+                    self._detach(key)
+                except OSError:
+                    logger.warning("Could not unmount %s" % key[0])
+
+    def _detach(self, key):
+        mount = self._mounts.pop(key)
+        if mount['timer'] is not None:
+            mount['timer'].cancel()
+
+        start = time.time()
+        try:
+            self.backend.detach(mount['mountpoint'])
+        finally:
+            self.detach_seconds += time.time() - start
+        self._digests.pop((key[0], mount['mountpoint']), None)
+        logger.info("Unmounted %s" % key[0])
+
+    def detach_idle(self):
+        """ Detaches all released images right away """
+        with self._lock:
+            for key, mount in list(self._mounts.items()):
+                if mount['owned'] and mount['refs'] == 0:
+                    self._detach(key)
+
+
+#: Disk Images attached by this process
+mounts = MountManager()
+atexit.register(mounts.detach_idle)
+
+
+def mount_dmg(dmg, unmount=False):
+    """ (Un)Mounts given DMG below /Volumes/, see MountManager """
     if unmount:
-        logger.info("Unmounted %s")
-        return_code = subprocess.call([
-            'hdiutil',
-            'detach',
-            mount_point
-        ], stdout=dnull)
+        mounts.release(dmg)
+        return None
+
+    return mounts.acquire(dmg)
+
+
+class DiskImageInfo(object):
+    """
+    Metadata of a UDIF Disk Image, read without attaching it.
+
+    Only the koly block at the end of the image and the XML plist it points
+    to are read, so this takes milliseconds even for multi-GB images. The
+    names of the volumes are stored inside the compressed filesystems and
+    are not available this way, but the partition names and filesystem
+    types are.
+    """
+
+    #: Chunk types of the block tables and the image formats they imply
+    FORMATS = {
+        0x80000004: 'UDCO',  # ADC
+        0x80000005: 'UDZO',  # zlib
+        0x80000006: 'UDBZ',  # bzip2
+        0x80000007: 'ULFO',  # lzfse
+        0x80000008: 'ULMO',  # lzma
+    }
+
+    #: Partition types and the filesystems they contain
+    FILESYSTEMS = [
+        ('Apple_APFS', 'APFS'),
+        ('Apple_HFSX', 'HFSX'),
+        ('Apple_HFS', 'HFS+'),
+        ('DOS_FAT', 'FAT'),
+    ]
+
+    def __init__(self, path):
+        """
+        Reads the metadata of the Disk Image at path.
+
+        Raises:
+            InvalidDiskImageException: is raised when path is no UDIF image,
+                e.g. because it is encrypted.
+            IOError: is raised when path cannot be read.
+        """
+        self.path = path
+
+        with open(path, 'rb') as f:
+            f.seek(0, 2)
+            self.size = f.tell()
+            if self.size < 512:
+                raise InvalidDiskImageException("%s is too short" % path)
+
+            f.seek(-512, 2)
+            koly = f.read(512)
+            if koly[:4] != b'koly':
+                raise InvalidDiskImageException("No koly block in %s" % path)
+
+            self.data_size = struct.unpack('>Q', koly[32:40])[0]
+            xml_offset, xml_length = struct.unpack('>QQ', koly[216:232])
+            self.sectors = struct.unpack('>Q', koly[492:500])[0]
+
+            f.seek(xml_offset)
+            xml = f.read(xml_length)
+
+        try:
+            plist = _read_plist(xml) if xml_length else {}
+        except Exception as e:
+            raise InvalidDiskImageException("Broken plist in %s: %s" %
+                                            (path, e))
+
+        self.partitions = []
+        types = set()
+        for blkx in plist.get('resource-fork', {}).get('blkx', []):
+            self.partitions.append(blkx.get('Name') or blkx.get('CFName'))
+            types.update(self._chunk_types(blkx.get('Data')))
+
+        self.format = 'UDRO'
+        for t, name in sorted(self.FORMATS.items()):
+            if t in types:
+                self.format = name
+
+        self.filesystem = None
+        for partition in self.partitions:
+            for ptype, fs in self.FILESYSTEMS:
+                if partition and ptype in partition:
+                    self.filesystem = self.filesystem or fs
+
+    @staticmethod
+    def _chunk_types(data):
+        """ Yields the chunk types of the mish block table data """
+        data = getattr(data, 'data', data)
+        if not data or data[:4] != b'mish' or len(data) < 204:
+            return
+
+        count = struct.unpack('>L', data[200:204])[0]
+        for i in range(count):
+            offset = 204 + 40 * i
+            yield struct.unpack('>L', data[offset:offset+4])[0]
+
+    @property
+    def uncompressed_size(self):
+        """ Size of the image's contents in bytes """
+        return self.sectors * 512
+
+    def __repr__(self):
+        return "<%s: %s %s, %d bytes>" % (self.__class__.__name__,
+                                         os.path.basename(self.path),
+                                         self.format, self.size)
+
+
+#: DiskImageInfos by path, size and mtime of the image
+_dmg_infos = {}
+
+
+def dmg_info(path):
+    """ Returns the DiskImageInfo of path, cached until the image changes """
+    st = os.stat(path)
+    key = (os.path.realpath(path), st.st_size, st.st_mtime)
+
+    info = _dmg_infos.get(key)
+    if info is None:
+        info = _dmg_infos[key] = DiskImageInfo(path)
+
+    return info
+
+
+def _stat_entries(directory, types, names=None):
+    """
+    Yields (name, stat) for every entry in directory with a type in types
+
+    Entries are discovered in a single scandir() pass where available, so
+    only entries with a valid type are ever stat'ed. If names is given, only
+    these entries are stat'ed and directory is not listed at all.
+    """
+    if names is None and scandir is not None:
+        entries = ((e.name, e.stat) for e in scandir(directory))
+    else:
+        if names is None:
+            names = os.listdir(directory)
+        entries = ((f, lambda f=f: os.stat(os.path.join(directory, f)))
+                   for f in names)
+
+    for name, stat_entry in entries:
+        if os.path.splitext(name.rstrip('/'))[1] not in types:
+            logger.log(logging.NOTSET, "No valid Installable at %s" % name)
+            continue
+
+        try:
+            yield name, stat_entry()
+        except OSError:
+            logger.debug("Could not stat %s" % os.path.join(directory, name))
+
+
+#: System folders on volumes which never contain Installables
+_VOLUME_SKIP = frozenset([
+    '.Trashes',
+    '.Spotlight-V100',
+    '.fseventsd',
+    '.DocumentRevisions-V100',
+    '.TemporaryItems',
+])
+
+
+def _walk_volume(root, types, depth=3, entries=10000, contents=os.listdir):
+    """
+    Yields (path, stat) for every entry below root with a type in types
+
+    The volume is walked breadth-first. Entries with a valid type are not
+    descended into, symlinks (like the usual link to /Applications) are
+    neither followed nor reported, and system folders like .Trashes are
+    skipped. Walking stops after depth levels or once entries entries have
+    been looked at, so huge volumes cannot stall an install. The root is
+    listed by contents, e.g. DiskImageBackend.contents, folders below it by
+    os.listdir.
+    """
+    level = [root]
+    seen = 0
+
+    for _ in range(depth):
+        deeper = []
+
+        for directory in level:
+            listdir = contents if directory == root else os.listdir
+            try:
+                names = sorted(listdir(directory))
+            except OSError:
+                logger.debug("Could not list %s" % directory)
+                continue
+
+            for name in names:
+                seen += 1
+                if seen > entries:
+                    logger.warning("Stopped walking %s after %d entries" %
+                                   (root, entries))
+                    return
+
+                if name in _VOLUME_SKIP:
+                    continue
+
+                path = os.path.join(directory, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    logger.debug("Could not stat %s" % path)
+                    continue
+
+                if stat.S_ISLNK(st.st_mode):
+                    continue
+
+                if os.path.splitext(name)[1] in types:
+                    yield path, st
+                elif stat.S_ISDIR(st.st_mode):
+                    deeper.append(path)
+
+        level = deeper
+        if not level:
+            return
+
+
+def _zip_member(name, types):
+    """ Returns the Installable that zip member name belongs to, or None """
+    if name.startswith("__MACOSX/"):
+        return None
+
+    t = os.path.splitext(name.rstrip('/'))[1]
+    if t in types and name.count(t+'/') == 1:
+        return name.split('.app/', 1)[0]+'.app/'
+
+    return None
+
+
+def _zip_names(path):
+    """
+    Yields the names of all members of the zipfile at path
+
+    Only the central directory is read, one record at a time, so the caller
+    can stop early without the whole directory being parsed.
+
+    Raises:
+        zipfile.BadZipfile: if path is not a valid zipfile.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        size = f.tell()
+
+        # End of Central Directory, followed by a comment of up to 64k
+        tail = min(size, 22 + 0xFFFF)
+        f.seek(size - tail)
+        data = f.read()
+        pos = data.rfind(b'PK\x05\x06')
+        if pos < 0 or len(data) - pos < 22:
+            raise zipfile.BadZipfile("No central directory in %s" % path)
+
+        eocd = size - tail + pos
+        count, cd_size, cd_offset = struct.unpack(
+            '<10xHLL', data[pos:pos+20])
+
+        # Zip64 End of Central Directory, announced by its locator
+        locator = data[max(pos-20, 0):pos]
+        if len(locator) == 20 and locator[:4] == b'PK\x06\x07':
+            eocd = struct.unpack('<8xQ4x', locator)[0]
+            f.seek(eocd)
+            record = f.read(56)
+            if len(record) != 56 or record[:4] != b'PK\x06\x06':
+                raise zipfile.BadZipfile("Broken zip64 record in %s" % path)
+            count, cd_size, cd_offset = struct.unpack('<32xQQQ', record)
+
+        # Data may be prepended to the archive, e.g. self-extracting zips
+        concat = eocd - cd_size - cd_offset
+        f.seek(cd_offset + concat)
+
+        for _ in range(count):
+            header = f.read(46)
+            if len(header) != 46 or header[:4] != b'PK\x01\x02':
+                raise zipfile.BadZipfile("Broken central directory in %s" %
+                                         path)
+            flags, = struct.unpack('<8xH', header[:10])
+            name_len, extra_len, comment_len = struct.unpack(
+                '<28xHHH', header[:34])
+
+            name = f.read(name_len)
+            f.seek(extra_len + comment_len, 1)
+
+            yield name.decode('utf-8' if flags & 0x800 else 'cp437')
+
+
+def _zip_has_installable(path, types):
+    """
+    Checks if the zipfile at path contains any Installable of types
+
+    Stops reading the central directory at the first hit.
+    """
+    for name in _zip_names(path):
+        if _zip_member(name, types) is not None:
+            return True
+
+    return False
+
+
+def _zip_target(dest, name):
+    """ Returns the path of zip member name inside dest, None if outside """
+    target = os.path.normpath(os.path.join(dest, name))
+    if not target.startswith(os.path.join(dest, '')):
+        return None
+    return target
+
+
+def _zip_mtime(info):
+    """ Returns the mtime of zip member info, exact if recorded by zip(1) """
+    extra = info.extra
+    while len(extra) >= 4:
+        tag, size = struct.unpack('<HH', extra[:4])
+        # Extended Timestamp, flag bit 0 announces the mtime
+        if tag == 0x5455 and size >= 5 and ord(extra[4:5]) & 1:
+            return struct.unpack('<l', extra[5:9])[0]
+        extra = extra[4+size:]
+
+    return time.mktime(info.date_time + (0, 0, -1))
+
+
+def _extract_files(job):
+    """
+    Extracts the files of job, a tuple of (path, files)
+
+    Each call opens its own handle on the zipfile at path, so jobs can run in
+    parallel threads or processes. files is a list of (name, target, mode,
+    mtime) tuples as planned by _extract_zip.
+    """
+    path, files = job
+
+    zf = zipfile.ZipFile(path, 'r')
+    try:
+        for name, target, mode, mtime in files:
+            src = zf.open(name)
+            with open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, _BUFSIZE)
+            src.close()
+
+            if mode:
+                os.chmod(target, stat.S_IMODE(mode))
+            os.utime(target, (mtime, mtime))
+    finally:
+        zf.close()
+
+
+def _extract_zip(path, members, dest, workers=None, processes=False):
+    """
+    Extracts the trees below members of the zipfile at path into dest
+
+    Extraction runs in ordered phases: all directories are created first,
+    then the files are written, then symlinks are created and finally the
+    modes and mtimes of the directories are set. Only the file phase runs in
+    parallel, so the result is the same for any number of workers. As
+    symlinks come after all files, no member is extracted through one.
+
+    Files are streamed to disk in chunks of _BUFSIZE. Unix permissions,
+    executable bits and symlinks are restored from the external attributes
+    of each member.
+
+    Args:
+        path: zipfile to extract from
+        members: Prefixes of the member trees to extract
+        dest: Directory to extract into
+        workers: Number of threads or processes writing files in parallel.
+            Defaults to None, i.e. writing files serially.
+        processes: Boolean. If set to 'True', workers are processes instead
+            of threads. Defaults to 'False'
+
+    Raises:
+        zipfile.BadZipfile: if path is not a valid zipfile.
+        IOError, OSError: if extraction failed.
+    """
+    dest = os.path.abspath(dest)
+    prefixes = tuple(members)
+    dirs, files, links = [], [], []
+    parents = set()
+
+    zf = zipfile.ZipFile(path, 'r')
+    try:
+        for info in zf.infolist():
+            if not info.filename.startswith(prefixes):
+                continue
+
+            target = _zip_target(dest, info.filename)
+            if target is None:
+                logger.warning("Skipping %s in %s" % (info.filename, path))
+                continue
+
+            mode = info.external_attr >> 16
+
+            if info.filename.endswith('/') or stat.S_ISDIR(mode):
+                parents.add(target)
+                dirs.append((target, mode, _zip_mtime(info)))
+            elif stat.S_ISLNK(mode):
+                parents.add(os.path.dirname(target))
+                links.append((target, zf.read(info).decode('utf-8')))
+            else:
+                parents.add(os.path.dirname(target))
+                files.append(
+                    (info.filename, target, mode, _zip_mtime(info)))
+    finally:
+        zf.close()
+
+    # Phase 1: Directories
+    for target in sorted(parents):
+        if not os.path.isdir(target):
+            os.makedirs(target)
+
+    # Phase 2: Files
+    if not workers or workers < 2 or len(files) < 2:
+        _extract_files((path, files))
     else:
-        logger.info("Mounted %s at %s" % (dmg, mount_point))
-        return_code = subprocess.call([
-            'hdiutil',
-            'attach',
-            '-mountpoint',
-            mount_point,
-            dmg
-        ], stdout=dnull)
+        jobs = [(path, files[i::workers]) for i in range(workers)]
+        if processes:
+            pool = multiprocessing.Pool(workers)
+            try:
+                pool.map(_extract_files, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            pool = _Pool(workers)
+            try:
+                for job in [pool.submit(_extract_files, j) for j in jobs]:
+                    job.get()
+            finally:
+                pool.shutdown()
+
+    # Phase 3: Symlinks
+    for target, link in links:
+        if os.path.lexists(target):
+            os.remove(target)
+        os.symlink(link, target)
+
+    # Phase 4: Directory metadata, deepest first, so read-only directories
+    # are restricted last
+    for target, mode, mtime in sorted(dirs, reverse=True):
+        if mode:
+            os.chmod(target, stat.S_IMODE(mode))
+        os.utime(target, (mtime, mtime))
+
+
+def _fsencode(path):
+    """ Returns path as bytes, as needed for ctypes """
+    if not isinstance(path, bytes):
+        path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+    return path
+
+
+def _native(s):
+    """ Returns text s as native str, encoded like paths on Python 2 """
+    if str is bytes and isinstance(s, unicode):
+        s = s.encode(sys.getfilesystemencoding() or 'utf-8')
+    return s
+
+
+def _text(s):
+    """ Returns native str s as text, the reverse of _native """
+    if str is bytes and isinstance(s, bytes):
+        s = s.decode(sys.getfilesystemencoding() or 'utf-8')
+    return s
+
+
+def _is_sparse(st):
+    """ Checks if the file of stat result st has holes """
+    blocks = getattr(st, 'st_blocks', None)
+    return blocks is not None and blocks * 512 < st.st_size
+
+
+def _file_digest(path):
+    """ Returns the SHA-256 hexdigest of the file at path """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        buf = f.read(_BUFSIZE)
+        while buf:
+            digest.update(buf)
+            buf = f.read(_BUFSIZE)
+    return digest.hexdigest()
+
+
+class _DigestPipeline(object):
+    """
+    Computes the digest of a file in the background
+
+    One thread reads the file into a ring of reusable buffers, while a
+    second thread feeds them to the digest. Both file reads and hashlib
+    release the GIL, so reading, hashing and whatever the calling thread
+    does (copying, extracting) overlap.
+    """
+
+    def __init__(self, path, algorithm='sha256', buffers=4,
+                 bufsize=8 * _BUFSIZE):
+        self.path = path
+        self._digest = hashlib.new(algorithm)
+        self._free = queue.Queue()
+        self._full = queue.Queue()
+        self._error = None
+        self._cancelled = False
+
+        for _ in range(buffers):
+            self._free.put(bytearray(bufsize))
+
+        self._threads = [threading.Thread(target=self._read),
+                         threading.Thread(target=self._hash)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def _read(self):
+        try:
+            with io.open(self.path, 'rb', buffering=0) as f:
+                while not self._cancelled:
+                    buf = self._free.get()
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    self._full.put((buf, n))
+        except (IOError, OSError) as e:
+            self._error = e
+        finally:
+            self._full.put(None)
+
+    def _hash(self):
+        while True:
+            item = self._full.get()
+            if item is None:
+                return
+            buf, n = item
+            self._digest.update(memoryview(buf)[:n])
+            self._free.put(buf)
+
+    def cancel(self):
+        """ Stops reading, without waiting for the threads """
+        self._cancelled = True
+
+    def hexdigest(self):
+        """
+        Waits for the whole file to be hashed and returns the hexdigest
+
+        Raises:
+            IOError: if the file could not be read.
+        """
+        for t in self._threads:
+            t.join()
+        if self._error is not None:
+            raise self._error
+        return self._digest.hexdigest()
 
-    # Minimal Error Handling
-    if return_code != 0:
-        logger.error("%d: %s" %
-                     (return_code, errno.errorcode[return_code]))
-        raise OSError(return_code)
 
-    return mount_point
+def _exchange(a, b):
+    """
+    Atomically exchanges the paths a and b
+
+    Returns:
+        False if the platform or filesystem does not support it.
+    """
+    if sys.platform == 'darwin' and hasattr(_libc, 'renamex_np'):
+        ret = _libc.renamex_np(_fsencode(a), _fsencode(b), _RENAME_SWAP)
+    elif hasattr(_libc, 'renameat2'):
+        ret = _libc.renameat2(_AT_FDCWD, _fsencode(a),
+                              _AT_FDCWD, _fsencode(b), _RENAME_EXCHANGE)
+    else:
+        return False
+
+    if ret != 0:
+        e = ctypes.get_errno()
+        if e in (errno.EINVAL, errno.ENOSYS, errno.ENOTSUP):
+            return False
+        raise OSError(e, os.strerror(e), a)
+
+    return True
+
+
+def _replace(staged, dest):
+    """
+    Moves the tree at staged to dest
+
+    An existing tree at dest is moved to the trash. Where the platform
+    supports it, both trees are exchanged atomically first, so dest is never
+    missing.
+    """
+    if os.path.lexists(dest) and _exchange(staged, dest):
+        logger.debug("Exchanged %s with %s" % (staged, dest))
+        send2trash.send2trash(staged)
+    else:
+        if os.path.lexists(dest):
+            send2trash.send2trash(dest)
+        os.rename(staged, dest)
+
+    logger.info("Moved %s into place" % dest)
+
+
+_dest_locks = {}
+_dest_locks_lock = threading.Lock()
+
+
+#: Held while the Installer runs, as it can only install one package at once
+_pkg_lock = threading.Lock()
+
+
+def _dest_lock(dest):
+    """
+    Returns the lock held while a bundle is installed to dest
+
+    Installables installed at the same time may contain the same bundle,
+    e.g. Foo.app, Foo.zip and Foo.dmg, which must not be written at once.
+    """
+    dest = os.path.realpath(dest)
+    with _dest_locks_lock:
+        return _dest_locks.setdefault(dest, threading.Lock())
+
+
+class TreeCopier(object):
+    """
+    Copies directory trees in-process, like 'cp -a'.
+
+    Modes, timestamps, symlinks and extended attributes are preserved. Each
+    file is copied with the cheapest primitive available: copyfile(3) with
+    cloning on Mac OS X, copy_file_range(2) on Linux, and a buffered copy
+    that keeps holes of sparse files otherwise. Trees on the same device can
+    also be moved by a single rename.
+
+    With workers set, the tree is walked once, files are copied by a pool
+    of threads and the metadata of directories is applied in a final pass.
+
+    With base set, files that did not change since an earlier version of the
+    tree are taken from that version instead of being read from the source.
+
+    The copier counts files and bytes, so throughput can be reported.
+    """
+
+    def __init__(self, workers=None, base=None, checksum=False):
+        """
+        Args:
+            workers: Number of threads copying files in parallel.
+                Defaults to None, i.e. copying serially.
+            base: Tree of an earlier version of the source. Files with the
+                same size and mtime at the same path inside base are cloned
+                or copied from there, so the copy never shares its files with
+                base. Must be on the same volume as the copy.
+                Defaults to None
+            checksum: Boolean. If set to 'True', files from base also need
+                the same SHA-256 digest. Defaults to 'False'
+        """
+        self.workers = workers
+        self.base = base
+        self.checksum = checksum
+        self.files = 0
+        self.bytes = 0
+        self.reused = 0
+        self.seconds = 0.0
+        self._src = None
+
+    @property
+    def bytes_per_sec(self):
+        """ Bytes copied per second """
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    @property
+    def files_per_sec(self):
+        """ Files copied per second """
+        return self.files / self.seconds if self.seconds else 0.0
+
+    def copy(self, src, dest, move=False):
+        """
+        Copies the tree at src to dest, which must not exist yet.
+
+        Args:
+            src: File, symlink or directory to copy
+                REQUIRED
+            dest: Path of the copy
+                REQUIRED
+            move: Boolean. If set to 'True' and src is on the same device as
+                dest, src is renamed to dest instead of being copied.
+                Defaults to 'False'
+
+        Raises:
+            OSError, IOError: if the copy failed.
+        """
+        start = time.time()
+        self._src = src
+
+        try:
+            parent = os.path.dirname(os.path.abspath(dest))
+            if move and os.lstat(src).st_dev == os.stat(parent).st_dev:
+                os.rename(src, dest)
+                self.files += 1
+                logger.debug("Moved %s to %s" % (src, dest))
+            elif self.workers and self.workers > 1:
+                self._copy_parallel(src, dest)
+            else:
+                self._copy(src, dest)
+        finally:
+            self.seconds += time.time() - start
+
+    def _copy(self, src, dest):
+        st = os.lstat(src)
+
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src), dest)
+            self._copy_metadata(src, dest, st)
+        elif stat.S_ISDIR(st.st_mode):
+            os.mkdir(dest)
+            for name in sorted(os.listdir(src)):
+                self._copy(os.path.join(src, name), os.path.join(dest, name))
+            # After the contents, so mtime and read-only modes are kept
+            self._copy_metadata(src, dest, st)
+        elif self._copy_file(src, dest, st):
+            self.reused += 1
+        else:
+            self.bytes += st.st_size
+
+        self.files += 1
+
+    def _copy_parallel(self, src, dest):
+        dirs, files, links = [], [], []
+
+        # Walk once, creating directories on the way
+        todo = [(src, dest)]
+        while todo:
+            s, d = todo.pop()
+            st = os.lstat(s)
+            if stat.S_ISLNK(st.st_mode):
+                links.append((s, d, st))
+            elif stat.S_ISDIR(st.st_mode):
+                os.mkdir(d)
+                dirs.append((s, d, st))
+                for name in sorted(os.listdir(s), reverse=True):
+                    todo.append((os.path.join(s, name), os.path.join(d, name)))
+            else:
+                files.append((s, d, st))
+
+        def copy_files(batch):
+            reused, copied = 0, 0
+            for s, d, st in batch:
+                if self._copy_file(s, d, st):
+                    reused += 1
+                else:
+                    copied += st.st_size
+            return reused, copied
+
+        pool = _Pool(self.workers)
+        try:
+            jobs = [pool.submit(copy_files, files[i::self.workers])
+                    for i in range(self.workers)]
+            for job in jobs:
+                reused, copied = job.get()
+                self.reused += reused
+                self.bytes += copied
+        finally:
+            pool.shutdown()
+
+        for s, d, st in links:
+            os.symlink(os.readlink(s), d)
+            self._copy_metadata(s, d, st)
+
+        # Deepest first, so read-only directories are restricted last
+        for s, d, st in reversed(dirs):
+            self._copy_metadata(s, d, st)
+
+        self.files += len(dirs) + len(files) + len(links)
+
+    def _copy_file(self, src, dest, st):
+        """ Copies a regular file, returns True if it was taken from base """
+        if self.base is not None and self._reuse(src, dest, st):
+            return True
+
+        if _copyfile is not None:
+            flags = _COPYFILE_ALL | _COPYFILE_CLONE
+            if _copyfile(_fsencode(src), _fsencode(dest), None, flags) < 0:
+                e = ctypes.get_errno()
+                raise OSError(e, os.strerror(e), src)
+            return False
+
+        with open(src, 'rb') as fsrc:
+            with open(dest, 'wb') as fdst:
+                if not self._copy_file_range(fsrc, fdst, st):
+                    self._copy_buffered(fsrc, fdst, st)
+
+        self._copy_metadata(src, dest, st)
+        return False
+
+    def _reuse(self, src, dest, st):
+        """ Takes src from base if it did not change, returns success """
+        old = os.path.join(self.base, os.path.relpath(src, self._src))
+
+        try:
+            ost = os.lstat(old)
+        except OSError:
+            return False
+
+        if not stat.S_ISREG(ost.st_mode) or ost.st_size != st.st_size or \
+                ost.st_mtime != st.st_mtime:
+            return False
+        if self.checksum and _file_digest(old) != _file_digest(src):
+            return False
+
+        try:
+            if _copyfile is not None:
+                flags = _COPYFILE_ALL | _COPYFILE_CLONE
+                if _copyfile(_fsencode(old), _fsencode(dest), None, flags) < 0:
+                    e = ctypes.get_errno()
+                    raise OSError(e, os.strerror(e), old)
+            else:
+                # A hard link would tie the old version, which goes to the
+                # trash, to the new one; copy from it in the kernel instead
+                with open(old, 'rb') as fsrc:
+                    with open(dest, 'wb') as fdst:
+                        if not self._copy_file_range(fsrc, fdst, ost):
+                            self._copy_buffered(fsrc, fdst, ost)
+        except (IOError, OSError) as e:
+            logger.debug("Could not reuse %s: %s" % (old, e))
+            if os.path.lexists(dest):
+                os.remove(dest)
+            return False
+
+        self._copy_metadata(src, dest, st)
+        return True
+
+    def _copy_file_range(self, fsrc, fdst, st):
+        """ Copies in the kernel, returns False if that is not supported """
+        if not hasattr(os, 'copy_file_range'):
+            return False
+
+        # Not all filesystems keep holes when copying in the kernel
+        if _is_sparse(st):
+            return False
+
+        copied = 0
+        while copied < st.st_size:
+            try:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                       st.st_size - copied)
+            except OSError as e:
+                if copied == 0 and e.errno in (errno.EXDEV, errno.ENOSYS,
+                                               errno.EINVAL, errno.EPERM,
+                                               errno.EOPNOTSUPP):
+                    return False
+                raise
+            if n == 0:
+                break
+            copied += n
+
+        return True
+
+    def _copy_buffered(self, fsrc, fdst, st):
+        """ Copies in chunks of _BUFSIZE, skipping holes of sparse files """
+        sparse = _is_sparse(st)
+
+        buf = fsrc.read(_BUFSIZE)
+        while buf:
+            if sparse and buf.count(b'\0') == len(buf):
+                fdst.seek(len(buf), 1)
+            else:
+                fdst.write(buf)
+            buf = fsrc.read(_BUFSIZE)
+
+        if sparse:
+            fdst.truncate()
+
+    def _copy_metadata(self, src, dest, st):
+        if _copyfile is not None:
+            flags = _COPYFILE_METADATA
+            if stat.S_ISLNK(st.st_mode):
+                flags |= _COPYFILE_NOFOLLOW
+            if _copyfile(_fsencode(src), _fsencode(dest), None, flags) < 0:
+                e = ctypes.get_errno()
+                raise OSError(e, os.strerror(e), src)
+            return
+
+        if not stat.S_ISLNK(st.st_mode):
+            # Copies xattrs as well on Python 3
+            shutil.copystat(src, dest)
+            return
+
+        try:
+            shutil.copystat(src, dest, follow_symlinks=False)
+        except (TypeError, NotImplementedError, OSError):
+            logger.debug("Could not copy metadata of symlink %s" % src)
+
+
+class _Timeout(Exception):
+    pass
+
+
+class _Job(object):
+    """ Result of a function submitted to a _Pool """
+
+    def __init__(self, fn, args):
+        self._fn = fn
+        self._args = args
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def run(self):
+        try:
+            self._result = self._fn(*self._args)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._done.set()
+
+    def get(self, timeout=None):
+        """
+        Waits for the job and returns its result
+
+        Raises:
+            _Timeout: if the job did not finish within timeout seconds.
+            Exception: whatever the job itself raised.
+        """
+        if not self._done.wait(timeout):
+            raise _Timeout()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class _Pool(object):
+    """
+    Bounded pool of worker threads
+
+    Workers are daemon threads, so a job blocking on a stalled filesystem
+    never keeps the process alive.
+    """
+
+    def __init__(self, workers):
+        self._queue = queue.Queue()
+        self._threads = []
+        for _ in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.run()
+
+    def submit(self, fn, *args):
+        """ Queues fn(*args) and returns its _Job """
+        job = _Job(fn, args)
+        self._queue.put(job)
+        return job
+
+    def shutdown(self, wait=True):
+        """
+        Stops the workers once all queued jobs are done
+
+        Args:
+            wait: Boolean. If set to 'True', waits for the workers to stop.
+                Defaults to 'True'
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+
+        if wait:
+            for t in self._threads:
+                t.join()
+
+
+def _remaining(deadline):
+    """ Seconds left until deadline, None if there is no deadline """
+    if deadline is None:
+        return None
+    return max(0, deadline - time.time())
 
 
 class NoApplicationException(Exception):
@@ -93,6 +1461,14 @@ class NotInstalledException(Exception):
     pass
 
 
+class InvalidDiskImageException(Exception):
+    pass
+
+
+class ChecksumMismatchException(Exception):
+    pass
+
+
 class Installable(object):
     """
     Specifices an installable object.
@@ -113,7 +1489,30 @@ class Installable(object):
         # '~/Desktop/',
     ]
 
-    def __init__(self, path, types=TYPES):
+    #: Number of Workers extracting zips and copying Apps in parallel;
+    #: None works serially
+    WORKERS = None
+
+    #: If set, Workers are Processes instead of Threads
+    WORKER_PROCESSES = False
+
+    #: If set, overwriting an App only rewrites the files that changed
+    UPGRADE = False
+
+    #: If set, files are only considered unchanged if their digests match
+    UPGRADE_CHECKSUM = False
+
+    #: Levels of folders searched for Installables on mounted Disk Images
+    VOLUME_DEPTH = 3
+
+    #: Number of entries looked at on mounted Disk Images before giving up
+    VOLUME_ENTRIES = 10000
+
+    #: hashlib algorithm of the checksums passed to install()
+    CHECKSUM_ALGORITHM = 'sha256'
+
+    def __init__(self, path, types=TYPES, inzip=None, stat=None,
+                 lazy=False, checked=False):
         """
         Creates new Instance of Installable from path.
 
@@ -125,6 +1524,20 @@ class Installable(object):
                 REQUIRED
             types: Types which to accept in path. Needs to be a subset of TYPES
                 Defaults to TYPES
+            inzip: List of Installables inside a zip, as found by an earlier
+                inspection. If given, the zipfile is not opened again.
+                Defaults to None
+            stat: Result of os.stat() for path, as found during discovery.
+                Provides ctime, size and mtime without another stat.
+                Defaults to None
+            lazy: Boolean. If set to 'True', zipfiles are only checked for
+                a first valid Installable. The complete list of Installables
+                inside is resolved by probe(), install() or len().
+                Defaults to 'False'
+            checked: Boolean. If set to 'True' together with lazy, the
+                zipfile is known to contain a valid Installable from an
+                earlier inspection and is not checked again.
+                Defaults to 'False'
 
         Raises:
             NoApplicationException: is raised when the type of 'path' is not in
@@ -143,33 +1556,73 @@ class Installable(object):
         # Special Zip Treatment
         # Only accept zips, if they include a valid type
         # Inside zips, ignore .zips and .dmgs
-        inzip = []
+        self.path = path
+        self.ext = ext
+        self._types = [t for t in types if t not in ('.zip', '.dmg')]
+        self._inzip = None
+        self._checksum = None
 
-        if ext == '.zip':
-            _types = list(types)
-            _types.remove('.zip')
-            _types.remove('.dmg')
+        if inzip is not None:
+            self._inzip = set(inzip)
+            if ext == '.zip' and not inzip:
+                logger.debug("No Installables in %s" % path)
+                raise NoApplicationException()
+        elif ext != '.zip':
+            self._inzip = set()
+        elif lazy:
+            if not checked and not _zip_has_installable(path, self._types):
+                logger.debug("No Installables in %s" % path)
+                raise NoApplicationException()
+        else:
+            self.probe()
 
-            zf = zipfile.ZipFile(path, 'r')
+        self.ctime = stat.st_ctime if stat is not None else None
+        self.size = stat.st_size if stat is not None else None
+        self.mtime = stat.st_mtime if stat is not None else None
 
-            for f in zf.namelist():
-                if f.startswith("__MACOSX/"):
-                    continue
+    @property
+    def inzip(self):
+        """Set of Installables inside a zipfile, resolved on first access"""
+        return self.probe()
 
-                t = os.path.splitext(f.rstrip('/'))[1]
-                if t in _types and f.count(t+'/') == 1:
-                    logger.info("Found Installable %s inside %s" % (f, path))
-                    inzip.append(f.split('.app/', 1)[0]+'.app/')
+    def probe(self):
+        """
+        Resolves the Installables inside a zipfile.
 
-            if not inzip:
-                logger.debug("No Installables in %s" % path)
-                raise NoApplicationException()
+        Lazily created Installables only inspect the complete zipfile when
+        this method is called, either explicitly or through install() and
+        len().
 
-        self.inzip = set(inzip)
-        self.path = path
-        self.ext = ext
+        Returns:
+            Set of the Installables inside the zipfile. For all other types
+            this Set is empty.
 
-    def _install_app(self, prefix, overrite=False, remove=False):
+        Raises:
+            NoApplicationException: is raised when the zipfile does not
+                contain any valid Installables.
+        """
+        if self._inzip is not None:
+            return self._inzip
+
+        inzip = set()
+
+        zf = zipfile.ZipFile(self.path, 'r')
+        for f in zf.namelist():
+            member = _zip_member(f, self._types)
+            if member is not None:
+                logger.info("Found Installable %s inside %s" % (f, self.path))
+                inzip.add(member)
+        zf.close()
+
+        if not inzip:
+            logger.debug("No Installables in %s" % self.path)
+            raise NoApplicationException()
+
+        self._inzip = inzip
+        return self._inzip
+
+    def _make_room(self, prefix, overrite=False):
+        """ Moves an existing App at prefix to the trash, returns its path """
         dest = os.path.join(prefix, os.path.basename(self.path))
         if os.path.exists(dest):
             if overrite:
@@ -180,47 +1633,136 @@ class Installable(object):
                 logger.error("File exists: %s" % dest)
                 raise OSError(17, "File exists", dest)
 
+        return dest
+
+    def _verify(self):
+        """
+        Waits for the checksum started by install() and compares it
+
+        Type-specific install functions call this before they install
+        anything to prefix, so a corrupt download is never installed.
+
+        Raises:
+            ChecksumMismatchException: if the checksums differ.
+        """
+        if self._checksum is None:
+            return
+
+        pipeline, expected = self._checksum
+        self._checksum = None
+
+        actual = pipeline.hexdigest()
+        if actual != expected.lower():
+            logger.error("Checksum of %s is %s, expected %s" %
+                         (self.path, actual, expected))
+            raise ChecksumMismatchException()
+        logger.debug("Verified checksum of %s" % self.path)
+
+    def _install_app(self, prefix, overrite=False, remove=False):
+        dest = os.path.join(prefix, os.path.basename(self.path))
+        with _dest_lock(dest):
+            self._install_app_locked(dest, prefix, overrite, remove)
+
+    def _install_app_locked(self, dest, prefix, overrite, remove):
+        upgrade = self.UPGRADE and overrite and os.path.isdir(dest) and \
+            not os.path.islink(dest)
+
         logger.debug(
             "Installing: %s" % os.path.basename(self.path))
-        return_code = subprocess.call(
-            ['/bin/cp', '-a', self.path, prefix])
 
-        # Minimal Error handling
-        if return_code != 0:
-            logger.error("%d: %s" %
-                         (return_code, errno.errorcode[return_code]))
-            raise OSError(return_code)
+        # The copy is staged next to dest and renamed into place, so a
+        # failed copy only ever removes its own tree
+        if upgrade:
+            # Take unchanged files from the installed App
+            copier = TreeCopier(workers=self.WORKERS, base=dest,
+                                checksum=self.UPGRADE_CHECKSUM)
+        else:
+            self._make_room(prefix, overrite=overrite)
+            copier = TreeCopier(workers=self.WORKERS)
+        stage = tempfile.mkdtemp(prefix='.install-', dir=prefix)
+        target = os.path.join(stage, os.path.basename(dest))
 
+        try:
+            try:
+                # If the source is going to be removed anyway, it can be moved
+                copier.copy(self.path, target, move=remove)
+                if upgrade:
+                    _replace(target, dest)
+                else:
+                    os.rename(target, dest)
+                self.bundles.append(dest)
+            except (IOError, OSError) as e:
+                logger.error("Could not copy %s: %s" % (self.path, e))
+                if remove and os.path.lexists(target) and \
+                        not os.path.lexists(self.path):
+                    # Give a moved source back instead of deleting it
+                    os.rename(target, self.path)
+                raise OSError(e.errno, e.strerror, self.path)
+        finally:
+            shutil.rmtree(stage, ignore_errors=True)
+
+        logger.info("Copied %d files (%d unchanged), %d bytes in %.2fs "
+                    "(%.1f MB/s, %.0f files/s)" %
+                    (copier.files, copier.reused, copier.bytes,
+                     copier.seconds, copier.bytes_per_sec / 1e6,
+                     copier.files_per_sec))
         logger.info("Installed %s to %s" % (self, prefix))
 
     def _install_zip(self, prefix, overrite=False, remove=False):
-        tmp = tempfile.gettempdir()
-
-        return_code = subprocess.call(
-            ['unzip', '-u', '-o', self.path, '-d', tmp]
-        )
+        # Stage on the same volume as prefix, so Apps can be renamed into
+        # place instead of being copied a second time
+        stage = tempfile.mkdtemp(prefix='.install-', dir=prefix)
 
-        # Minimal Error handling
-        if return_code != 0:
-            logger.error("%d: %s" %
-                         (return_code, errno.errorcode[return_code]))
-            raise OSError(return_code)
+        try:
+            try:
+                _extract_zip(self.path, self.inzip, stage,
+                             workers=self.WORKERS,
+                             processes=self.WORKER_PROCESSES)
+            except (IOError, zipfile.BadZipfile) as e:
+                logger.error("Could not extract %s: %s" % (self.path, e))
+                raise OSError(errno.EIO, str(e), self.path)
+
+            # The zip was hashed while it was extracted
+            self._verify()
+
+            for f in self.inzip:
+                a = Installable(os.path.join(stage, f))
+                if a.ext != '.app':
+                    a.install(prefix, overrite=overrite)
+                    self.bundles.extend(a.bundles)
+                    continue
 
-        for f in self.inzip:
-            a = Installable(os.path.join(tmp, f))
-            a.install(prefix, overrite=overrite)
+                dest = os.path.join(prefix, os.path.basename(a.path))
+                with _dest_lock(dest):
+                    if not overrite:
+                        a._make_room(prefix)
+                    _replace(a.path, dest)
+                self.bundles.append(dest)
+                logger.info("Installed %s to %s" % (a, prefix))
+        finally:
+            shutil.rmtree(stage, ignore_errors=True)
 
     def _install_dmg(self, prefix, overrite=False, remove=False):
         where = mount_dmg(self.path)
 
-        apps = self.get_installables(path=where)
-        for app in apps:
-            app.install(prefix, overrite=overrite)
+        try:
+            # The image was hashed while hdiutil attached it
+            self._verify()
 
-        mount_dmg(self.path, unmount=True)
+            for app in self.get_volume_installables(
+                    where, self._types, contents=mounts.backend.contents):
+                app.install(prefix, overrite=overrite)
+                self.bundles.extend(app.bundles)
+        finally:
+            mount_dmg(self.path, unmount=True)
 
     def _install_pkg(self, prefix=None, overrite=False, remove=False):
-        return_code = subprocess.call(['open', '-W', self.path])
+        self._verify()
+
+        # Packages from zips and Disk Images are installed by the workers of
+        # install_many, next to the ones it installs itself
+        with _pkg_lock:
+            return_code = subprocess.call(['open', '-W', self.path])
 
         # Minimal Error handling
         if return_code != 0:
@@ -230,6 +1772,7 @@ class Installable(object):
 
     def _install_alfredworkflow(self, prefix="/",
                                 overrite=False, remove=False):
+        self._verify()
         if remove:
             tmp = tempfile.gettempdir()
 
@@ -256,11 +1799,13 @@ class Installable(object):
                          (return_code, errno.errorcode[return_code]))
             raise OSError(return_code)
 
-    def install(self, prefix='/Applications/', remove=False, overrite=False):
+    def install(self, prefix='/Applications/', remove=False, overrite=False,
+                ledger=None, checksum=None):
         """
         Installs the Applications referenced by this Instance.
 
         This method is mainly a wrapper around type-specific install functions.
+        The paths of all installed bundles are collected in self.bundles.
 
         Args:
             prefix: Path to where Applications ('.app') shall be installed.
@@ -273,6 +1818,19 @@ class Installable(object):
             overrite: Boolean. If set to 'True', will overrite existing Apps at
                 path.
                 Defaults to 'False'
+            ledger: Path to an InstallLedger file, or an InstallLedger. If
+                the ledger shows that this object was installed to prefix
+                before and the installed bundles still have the recorded
+                versions, nothing is copied again. Successful installs are
+                recorded in the ledger.
+                Defaults to None
+            checksum: Hexdigest of the expected CHECKSUM_ALGORITHM checksum of
+                the file. It is computed in the background while Disk Images
+                are attached and zips are extracted, and checked before any
+                Application is moved into place. Zips are extracted into a
+                hidden folder inside prefix first, which is removed if the
+                checksum does not match. Bundles cannot be verified.
+                Defaults to None
 
         Returns:
             Original Path of the referenced object on success, None otherwise.
@@ -281,6 +1839,9 @@ class Installable(object):
             OSError: is raised on several occasions, when installation failed.
                 This can for example happen, when you dont have Permissions at
                 path.
+            ChecksumMismatchException: is raised when checksum does not match
+                the file. Nothing has been installed then.
+            ValueError: is raised when a checksum is given for a bundle.
         """
 
         logger.debug(
@@ -293,12 +1854,43 @@ class Installable(object):
         except AttributeError:
             pass
 
-        getattr(self, "_install" + self.ext.replace('.', "_"))(
-            prefix=prefix,
-            overrite=overrite,
-            remove=remove,
-        )
-        logger.info("Installed %s to %s" % (self, prefix))
+        if ledger is not None and not isinstance(ledger, InstallLedger):
+            ledger = InstallLedger(ledger)
+
+        bundles = None
+        if ledger is not None:
+            # The source may be moved during installation, so its digest is
+            # taken before
+            source = ledger.digest(self)
+            bundles = ledger.lookup(source, prefix)
+
+        if bundles is not None:
+            logger.info("%s is already installed to %s" % (self, prefix))
+            self.bundles = bundles
+        else:
+            if checksum is not None:
+                if os.path.isdir(self.path):
+                    raise ValueError("Cannot verify checksum of %s" %
+                                     self.path)
+                pipeline = _DigestPipeline(self.path, self.CHECKSUM_ALGORITHM)
+                self._checksum = (pipeline, checksum)
+
+            self.bundles = []
+            try:
+                getattr(self, "_install" + self.ext.replace('.', "_"))(
+                    prefix=prefix,
+                    overrite=overrite,
+                    remove=remove,
+                )
+            finally:
+                if self._checksum is not None:
+                    self._checksum[0].cancel()
+                    self._checksum = None
+            logger.info("Installed %s to %s" % (self, prefix))
+
+            if ledger is not None:
+                ledger.record(source, prefix, self.bundles)
+                ledger.save()
 
         self.installed = True
 
@@ -326,6 +1918,12 @@ class Installable(object):
             logger.debug("Cant remove %s!" % self)
             raise NotInstalledException()
 
+        # Apps are moved instead of copied, if they are to be removed
+        if not os.path.lexists(self.path):
+            logger.info("%s was moved during installation." % self)
+            self.removed = True
+            return
+
         try:
             send2trash.send2trash(self.path)
             self.removed = True
@@ -351,7 +1949,8 @@ class Installable(object):
 
     # Static Methods
     @staticmethod
-    def get_installables(paths=PATHS, types=TYPES):
+    def get_installables(paths=PATHS, types=TYPES, index=None, lazy=False,
+                         workers=None, timeout=None):
         """
         Finds installable objects
 
@@ -360,21 +1959,589 @@ class Installable(object):
                 Defaults to Installable.PATHS
             types: List of Types to recognize as installable objects. Must be
                 a subset of Installable.TYPES. Defaults to Installable.TYPES
+            index: Path to a ScanIndex file. If given, results of earlier
+                scans are reused for entries that did not change and the
+                index is updated afterwards. Defaults to None
+            lazy: Boolean. If set to 'True', zipfiles are only checked for a
+                first valid Installable, see Installable().
+                Defaults to 'False'
+            workers: Number of threads used per path to scan it and inspect
+                its entries concurrently. All paths are scanned at the same
+                time. Results are ordered by path and name.
+                Defaults to None, i.e. scanning serially.
+            timeout: Seconds after the start of its scan after which the
+                results of a path still being scanned are left out. Only used
+                together with workers.
+                Defaults to None
 
         Returns:
             a List of Installable() objects.
         """
 
+        scan_index = ScanIndex(index, types) if index else None
+
+        if workers:
+            inst = Installable._scan_concurrent(
+                paths, types, scan_index, lazy, workers, timeout)
+            if scan_index is not None:
+                scan_index.save()
+            return inst
+
         inst = []
 
         for p in paths:
             p = os.path.expanduser(p)
-            for f in os.listdir(p):
+            names = scan_index.names(p) if scan_index is not None else None
+
+            for f, st in _stat_entries(p, types, names):
                 try:
-                    i = Installable(os.path.join(p, f), types=types)
+                    if scan_index is None:
+                        i = Installable(os.path.join(p, f), types=types,
+                                        stat=st, lazy=lazy)
+                    else:
+                        i = scan_index.lookup(p, f, st, lazy=lazy)
                     logger.info("Found Installable at '%s'" % i.path)
                     inst.append(i)
                 except NoApplicationException:
                     logger.log(logging.NOTSET, "No valid Installable at %s")
 
+        if scan_index is not None:
+            scan_index.save()
+
+        return inst
+
+    @staticmethod
+    def get_volume_installables(root, types=TYPES, lazy=False, contents=None):
+        """
+        Finds installable objects anywhere on a mounted volume
+
+        Unlike get_installables(), folders are searched recursively, but
+        not below Installables that were found, and not deeper than
+        VOLUME_DEPTH levels or beyond VOLUME_ENTRIES entries.
+
+        Args:
+            root: Path of the mounted volume
+                REQUIRED
+            types: List of Types to recognize as installable objects. Must be
+                a subset of Installable.TYPES. Defaults to Installable.TYPES
+            lazy: Boolean. See get_installables().
+                Defaults to 'False'
+            contents: Function listing the names at the root of the volume,
+                like DiskImageBackend.contents. Defaults to os.listdir
+
+        Returns:
+            a List of Installable() objects, ordered by depth and name.
+        """
+        inst = []
+
+        for path, st in _walk_volume(root, types,
+                                     depth=Installable.VOLUME_DEPTH,
+                                     entries=Installable.VOLUME_ENTRIES,
+                                     contents=contents or os.listdir):
+            try:
+                i = Installable(path, types=types, stat=st, lazy=lazy)
+                logger.info("Found Installable at '%s'" % i.path)
+                inst.append(i)
+            except NoApplicationException:
+                logger.log(logging.NOTSET, "No valid Installable at %s" % path)
+
         return inst
+
+    @staticmethod
+    def _scan_concurrent(paths, types, scan_index, lazy, workers, timeout):
+        """ Concurrent variant of get_installables, see there """
+
+        def inspect(p, f, st):
+            if scan_index is None:
+                return Installable(os.path.join(p, f), types=types,
+                                   stat=st, lazy=lazy)
+            return scan_index.lookup(p, f, st, lazy=lazy)
+
+        def discover(pool, p):
+            names = scan_index.names(p) if scan_index is not None else None
+            entries = sorted(_stat_entries(p, types, names))
+            return [pool.submit(inspect, p, f, st) for f, st in entries]
+
+        # Every path gets its own workers and deadline, so jobs stalled on
+        # one path never keep the others from being scanned
+        scans = []
+        for p in paths:
+            p = os.path.expanduser(p)
+            pool = _Pool(workers)
+            deadline = time.time() + timeout if timeout else None
+            scans.append((p, pool, deadline, pool.submit(discover, pool, p)))
+
+        inst = []
+        try:
+            for p, pool, deadline, scan in scans:
+                found = []
+                try:
+                    for job in scan.get(_remaining(deadline)):
+                        try:
+                            found.append(job.get(_remaining(deadline)))
+                        except NoApplicationException:
+                            logger.log(logging.NOTSET,
+                                       "No valid Installable at %s")
+                except _Timeout:
+                    logger.warning("Timeout while scanning %s" % p)
+                    if scan_index is not None:
+                        scan_index.discard(p)
+
+                for i in found:
+                    logger.info("Found Installable at '%s'" % i.path)
+                inst.extend(found)
+        finally:
+            # Workers may still hang on a stalled path
+            for p, pool, deadline, scan in scans:
+                pool.shutdown(wait=False)
+
+        return inst
+
+
+class ScanIndex(object):
+    """
+    Persistent index of the results of Installable.get_installables.
+
+    For every search path the index stores the mtime of the directory and,
+    for every entry with a valid type, the result of its inspection keyed by
+    (inode, size, mtime). Entries whose key did not change are not inspected
+    again, directories whose mtime did not change are not listed again,
+    unless their last listing was within MTIME_RESOLUTION of that mtime.
+    """
+
+    #: Version of the on-disk format; indexes of other versions are discarded
+    VERSION = 3
+
+    #: Seconds a directory needs to have been listed after its mtime, before
+    #: the listing is trusted. HFS+ stores mtimes to the second, so a change
+    #: within the same second as a listing keeps the mtime.
+    MTIME_RESOLUTION = 2
+
+    def __init__(self, path, types=Installable.TYPES):
+        """
+        Loads the index at path.
+
+        A missing or unreadable index is treated as empty.
+
+        Args:
+            path: File in which the index is stored
+                REQUIRED
+            types: Types the index was built for. An index which was built for
+                other types is discarded.
+                Defaults to Installable.TYPES
+        """
+        self.path = path
+        self.types = sorted(types)
+        self.dirs = {}
+        self._seen = {}
+
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data['version'] == self.VERSION and \
+                    data['types'] == self.types:
+                self.dirs = self._convert(data['dirs'], _native)
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            logger.debug("Starting new scan index at %s" % path)
+
+    @staticmethod
+    def _convert(dirs, convert):
+        """
+        Applies convert to the directories and names in dirs.
+
+        JSON only holds text, while paths on Python 2 are byte strings.
+        Directories whose paths cannot be converted are left out, so they
+        are scanned again.
+        """
+        converted = {}
+        for directory, cached in dirs.items():
+            try:
+                converted[convert(directory)] = {
+                    'mtime': cached['mtime'],
+                    'scanned': cached['scanned'],
+                    'entries': dict((convert(n), e)
+                                    for n, e in cached['entries'].items()),
+                }
+            except UnicodeError:
+                logger.debug("Cannot index %r" % directory)
+        return converted
+
+    def names(self, directory):
+        """
+        Returns the names of all indexed entries in directory.
+
+        If the mtime of directory changed since the last scan, or the last
+        scan was too close to the mtime to be trusted, None is returned and
+        directory needs to be listed again.
+        """
+        directory = _native(directory)
+        mtime = os.stat(directory).st_mtime
+        cached = self.dirs.get(directory)
+
+        self._seen[directory] = {'mtime': mtime, 'scanned': time.time(),
+                                 'entries': {}}
+
+        if cached is not None and cached['mtime'] == mtime and \
+                self._trusted(cached):
+            logger.debug("%s unchanged, using index" % directory)
+            return list(cached['entries'])
+
+        return None
+
+    def _trusted(self, cached):
+        """ Whether the listing of a directory still holds for its mtime """
+        if cached['mtime'] is None or cached['scanned'] is None:
+            return False
+        return cached['scanned'] - cached['mtime'] >= self.MTIME_RESOLUTION
+
+    def _changed(self, directory, seen):
+        """ Whether seen differs from what the index holds for directory """
+        cached = self.dirs.get(directory)
+        if cached is None:
+            return True
+        return cached['mtime'] != seen['mtime'] or \
+            cached['entries'] != seen['entries'] or \
+            self._trusted(cached) != self._trusted(seen)
+
+    def lookup(self, directory, name, st, lazy=False):
+        """
+        Returns the Installable for name inside directory.
+
+        The entry is only inspected if its (inode, size, mtime) differ from
+        the ones recorded in the index.
+
+        Args:
+            directory: Directory containing the entry, as passed to names()
+            name: Name of the entry inside directory
+            st: Result of os.stat() for the entry
+            lazy: Boolean. Passed on to Installable(), if the Installables
+                inside a zipfile have not been resolved before.
+                Defaults to 'False'
+
+        Raises:
+            NoApplicationException: if the entry is not a valid Installable.
+        """
+        directory, name = _native(directory), _native(name)
+        path = os.path.join(directory, name)
+        key = [st.st_ino, st.st_size, st.st_mtime]
+
+        cached = self.dirs.get(directory, {}).get('entries', {}).get(name)
+        entries = self._seen.setdefault(
+            directory, {'mtime': None, 'scanned': None, 'entries': {}}
+        )['entries']
+
+        if cached is not None and cached['key'] == key:
+            if not cached['valid']:
+                entries[name] = cached
+                raise NoApplicationException()
+            if cached['inzip'] is not None or lazy:
+                entries[name] = cached
+                return Installable(path, types=self.types, stat=st,
+                                   inzip=cached['inzip'], lazy=lazy,
+                                   checked=True)
+
+        try:
+            i = Installable(path, types=self.types, stat=st, lazy=lazy)
+        except NoApplicationException:
+            entries[name] = {'key': key, 'valid': False, 'inzip': None}
+            raise
+
+        # Only record the Installables inside zips, if they were resolved
+        inzip = sorted(i._inzip) if i._inzip is not None else None
+        entries[name] = {'key': key, 'valid': True, 'inzip': inzip}
+        return i
+
+    def discard(self, directory):
+        """
+        Drops everything recorded for directory during this scan.
+
+        Used for incomplete scans, so the index keeps the previous state of
+        directory instead of a partial one.
+        """
+        self._seen.pop(_native(directory), None)
+
+    def save(self):
+        """
+        Writes all directories scanned since loading back to the index.
+
+        The index is written to a temporary file first and then renamed, so
+        concurrent scans never see a partially written index. If nothing
+        changed, the index is not written at all.
+        """
+        changed = [d for d, seen in self._seen.items()
+                   if self._changed(d, seen)]
+        self.dirs.update(self._seen)
+        self._seen = {}
+
+        if not changed:
+            logger.debug("Scan index %s unchanged" % self.path)
+            return
+
+        data = {
+            'version': self.VERSION,
+            'types': self.types,
+            'dirs': self._convert(self.dirs, _text),
+        }
+
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            logger.warning("Could not write scan index %s: %s" % (self.path, e))
+
+
+class InstallLedger(object):
+    """
+    Persistent record of what Installable.install has installed.
+
+    For every source the ledger stores, per prefix, the installed bundles
+    and the versions from their Info.plist. Sources are identified by a
+    digest. A (name, size, mtime) key is kept for each digest, so unchanged
+    downloads are recognized without reading them.
+    """
+
+    #: Version of the on-disk format; ledgers of other versions are discarded
+    VERSION = 1
+
+    def __init__(self, path, checksum=False):
+        """
+        Loads the ledger at path.
+
+        A missing or unreadable ledger is treated as empty.
+
+        Args:
+            path: File in which the ledger is stored
+                REQUIRED
+            checksum: Boolean. If set to 'True', files are identified by the
+                SHA-256 of their complete contents instead of their size and
+                first and last block. Bundles are always identified by their
+                inode and mtime.
+                Defaults to 'False'
+        """
+        self.path = path
+        self.checksum = checksum
+        self.sources = {}
+        self.files = {}
+        self._lock = threading.Lock()
+
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data['version'] == self.VERSION and \
+                    data['checksum'] == checksum:
+                self.sources = data['sources']
+                self.files = data['files']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            logger.debug("Starting new install ledger at %s" % path)
+
+    def digest(self, installable):
+        """ Returns the digest identifying the source of installable """
+        st = os.stat(installable.path)
+        key = "%s:%d:%r" % (os.path.basename(installable.path),
+                            st.st_size, st.st_mtime)
+
+        with self._lock:
+            digest = self.files.get(key)
+        if digest is not None:
+            return digest
+
+        if self.checksum and not os.path.isdir(installable.path):
+            digest = _file_digest(installable.path)
+        else:
+            digest = _quick_digest(installable.path)
+
+        with self._lock:
+            self.files[key] = digest
+        return digest
+
+    def lookup(self, digest, prefix):
+        """
+        Returns the bundles installed from digest to prefix.
+
+        None is returned, if nothing was recorded or if any of the bundles
+        was removed or now has another version.
+        """
+        prefix = os.path.realpath(prefix)
+        with self._lock:
+            bundles = self.sources.get(digest, {}).get(prefix)
+
+        if not bundles:
+            return None
+
+        # Bundles without a readable version cannot be told apart, so they
+        # never count as installed
+        for b in bundles:
+            version = _bundle_version(b['path']) \
+                if os.path.isdir(b['path']) else None
+            if version is None or version != b['version']:
+                logger.debug("%s changed since it was installed" % b['path'])
+                return None
+
+        return [b['path'] for b in bundles]
+
+    def record(self, digest, prefix, bundles):
+        """
+        Records that bundles were installed from digest to prefix.
+
+        Nothing is recorded without bundles, e.g. for packages, as their
+        installation cannot be checked later.
+        """
+        if not bundles:
+            return
+
+        entry = [{'path': os.path.abspath(b), 'version': _bundle_version(b)}
+                 for b in bundles]
+
+        with self._lock:
+            self.sources.setdefault(digest, {})[os.path.realpath(prefix)] = \
+                entry
+
+    def save(self):
+        """
+        Writes the ledger.
+
+        The ledger is written to a temporary file first and then renamed, so
+        a crash never leaves a partially written ledger.
+        """
+        # Written under the lock, so concurrent saves cannot rename an older
+        # state over a newer one
+        with self._lock:
+            data = json.dumps({
+                'version': self.VERSION,
+                'checksum': self.checksum,
+                'sources': self.sources,
+                'files': self.files,
+            })
+
+            try:
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                os.rename(tmp, self.path)
+            except (IOError, OSError) as e:
+                logger.warning("Could not write install ledger %s: %s" %
+                               (self.path, e))
+
+
+def install_many(installables, prefix='/Applications/', remove=False,
+                 overrite=False, extractors=2, copiers=4, ledger=None):
+    """
+    Installs several Installables in one run.
+
+    Zips are extracted by a pool of extractors, while Apps, Disk Images and
+    Workflows are installed by a separate pool of copiers, so CPU-bound
+    extraction and I/O-bound copies overlap. Packages open the graphical
+    Installer and are therefore installed one after another.
+
+    Args:
+        installables: List of Installable() objects
+            REQUIRED
+        prefix, remove, overrite: see Installable.install
+        extractors: Number of zips extracted at the same time.
+            Defaults to 2
+        copiers: Number of Apps, Disk Images and Workflows installed at the
+            same time. Defaults to 4
+        ledger: Path to an InstallLedger file, shared by all Installables,
+            see Installable.install. Defaults to None
+
+    Returns:
+        a List with one dict per Installable, in the order of installables.
+        Each dict holds the 'path' of the Installable, whether it was
+        'installed', the 'error' if not, and the 'seconds' it took.
+    """
+
+    if ledger is not None:
+        ledger = InstallLedger(ledger)
+
+    def run(i):
+        result = {'path': i.path, 'installed': False, 'error': None}
+        start = time.time()
+        try:
+            if i.install(prefix=prefix, remove=remove, overrite=overrite,
+                         ledger=ledger) == i.path:
+                result['installed'] = True
+            else:
+                result['error'] = "Installable has been removed"
+        except Exception as e:
+            logger.error("Could not install %s: %s" % (i.path, e))
+            result['error'] = str(e) or e.__class__.__name__
+        result['seconds'] = time.time() - start
+        return result
+
+    extract_pool = _Pool(extractors)
+    copy_pool = _Pool(copiers)
+
+    try:
+        jobs = []
+        for i in installables:
+            if i.ext == '.pkg':
+                jobs.append(i)
+            elif i.ext == '.zip':
+                jobs.append(extract_pool.submit(run, i))
+            else:
+                jobs.append(copy_pool.submit(run, i))
+
+        # Packages run in this thread, while the pools keep working
+        results = [run(j) if isinstance(j, Installable) else j for j in jobs]
+        results = [r.get() if isinstance(r, _Job) else r for r in results]
+    finally:
+        extract_pool.shutdown()
+        copy_pool.shutdown()
+
+    return results
+
+
+def main(argv=None):
+    """ Command line interface to install_many """
+    parser = argparse.ArgumentParser(
+        description="Installs Mac OS X Applications from dmgs, zips, pkgs "
+                    "and apps. Directories are searched for installables.")
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help="installable or directory of installables")
+    parser.add_argument('-p', '--prefix', default='/Applications/',
+                        help="where to install Apps (default: %(default)s)")
+    parser.add_argument('-o', '--overrite', action='store_true',
+                        help="overwrite existing Apps")
+    parser.add_argument('-r', '--remove', action='store_true',
+                        help="move installables to the trash afterwards")
+    parser.add_argument('-e', '--extractors', type=int, default=2,
+                        help="zips extracted at once (default: %(default)s)")
+    parser.add_argument('-c', '--copiers', type=int, default=4,
+                        help="Apps copied at once (default: %(default)s)")
+    parser.add_argument('-l', '--ledger', metavar='FILE',
+                        help="skip installables already installed according "
+                             "to FILE, and record new installs there")
+    args = parser.parse_args(argv)
+
+    installables, failed = [], 0
+    for p in args.paths:
+        if os.path.isdir(p) and \
+                os.path.splitext(p.rstrip('/'))[1] not in Installable.TYPES:
+            installables.extend(Installable.get_installables([p]))
+            continue
+
+        try:
+            installables.append(Installable(p))
+        except NoApplicationException:
+            print("%s: no valid application found" % p)
+            failed += 1
+
+    results = install_many(installables, prefix=args.prefix,
+                           remove=args.remove, overrite=args.overrite,
+                           extractors=args.extractors, copiers=args.copiers,
+                           ledger=args.ledger)
+
+    for r in results:
+        if r['installed']:
+            print("%s: installed (%.1fs)" % (r['path'], r['seconds']))
+        else:
+            print("%s: failed: %s" % (r['path'], r['error']))
+            failed += 1
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())